@@ -0,0 +1,321 @@
+"""
+Hot path benchmarks.
+
+Every benchmark runs an operation over a realistic mix of frames and reports frames per second,
+nanoseconds per frame and memory allocated per frame. Results go to a JSON file; passing the file
+of an earlier run with --compare reports regressions and makes the script exit with status 1.
+
+CPython doesn't count allocations, so memory is measured with tracemalloc on a separate pass:
+`alloc_bytes` is the peak of memory allocated while handling one frame, `retained_blocks` the
+number of memory blocks still alive per frame after the timed runs (anything above 0 is a leak
+or a cache being filled).
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+import typing
+
+from pyconz import framing, protocol
+from pyconz.connection import SerialConnection, Message
+from pyconz.protocol import *
+from pyconz.utils import Buffer
+
+logger = logging.getLogger(__name__)
+
+# serial reads usually return this much data
+READ_SIZE = 64
+# connected, room for APS requests: keeps the connection from asking for more data
+IDLE_STATE = NetworkState.CONNECTED.value | DeviceState.APSDE_DATA_REQUEST.value
+
+
+def _indication(src_nwk, cluster_id, data, seq):
+    return protocol.response_schemas[CommandId.APS_DATA_INDICATION].encode(
+        seq, IDLE_STATE, Address(AddressType.NWK, 0, 1), Address(AddressType.NWK, src_nwk, 1),
+        0x0104, cluster_id, data, 0xb4, -52)
+
+
+def make_frames(count, seed=0):
+    # type: (int, int) -> typing.List[bytes]
+    """
+    Device to host frames (checksum included, not SLIP-encoded) in the proportions of a busy network:
+    mostly short attribute reports, some multi-attribute reports and neighbour tables, state changes
+    and APS confirms.
+    """
+    rnd = random.Random(seed)
+    ret = []
+    for seq in range(count):
+        seq &= 0xff
+        src = 0x1000 + rnd.randrange(200)
+        kind = rnd.random()
+        if kind < 0.6:
+            # temperature report
+            body = _indication(src, 0x0402, bytes([0x18, seq, 0x0a, 0x00, 0x00, 0x29]) + rnd.randbytes(2), seq)
+        elif kind < 0.75:
+            # on/off, level and color reports of a light
+            data = bytes([0x18, seq, 0x0a]) + rnd.randbytes(5 * rnd.randrange(2, 6))
+            body = _indication(src, 0x0300, data, seq)
+        elif kind < 0.8:
+            # Mgmt_Lqi_rsp with 3 neighbours
+            body = _indication(src, 0x8031, bytes([seq, 0, 12, 0, 3]) + rnd.randbytes(22 * 3), seq)
+        elif kind < 0.9:
+            body = protocol.response_schemas[CommandId.DEVICE_STATE_CHANGED].encode(seq, IDLE_STATE)
+        else:
+            body = protocol.response_schemas[CommandId.APS_DATA_CONFIRM].encode(
+                seq, IDLE_STATE, seq, Address(AddressType.NWK, src, 1), 1, 0)
+        ret.append(body + crc(body))
+    return ret
+
+
+def make_stream(frames):
+    # type: (typing.List[bytes]) -> typing.List[bytes]
+    """
+    SLIP-encodes the frames and cuts the result into serial reads
+    """
+    data = b''.join(framing.encode(i) for i in frames)
+    return [data[i:i + READ_SIZE] for i in range(0, len(data), READ_SIZE)]
+
+
+def make_messages(count, seed=0):
+    # type: (int, int) -> typing.List[Message]
+    rnd = random.Random(seed)
+    ret = []
+    for i in range(count):
+        msg = Message()
+        msg.src = Address(AddressType.NWK, 0, 1)
+        msg.dest = Address(AddressType.NWK, 0x1000 + rnd.randrange(200), 1)
+        msg.profile_id = 0x0104
+        msg.cluster_id = 0x0006
+        msg.request_id = i & 0xff
+        msg.data = bytes([0x01, i & 0xff, rnd.randrange(3)])
+        ret.append(msg)
+    return ret
+
+
+class _NullTransport:
+    def write(self, data):
+        pass
+
+
+class _BenchConnection(SerialConnection):
+    def handle_incoming_message(self, msg):
+        pass
+
+
+def _connection():
+    conn = _BenchConnection()
+    conn._transport = _NullTransport()
+    return conn
+
+
+# Each benchmark gets the frame count and returns (items, run). `run` processes all items once and
+# returns how many frames that were; `items` is also used to measure a single frame's allocations.
+
+def bench_crc(n):
+    bodies = [i[:-2] for i in make_frames(n)]
+
+    def run(items):
+        for i in items:
+            crc(i)
+        return len(items)
+    return bodies, run
+
+
+def bench_buffer(n):
+    frames = make_frames(n)
+
+    def run(items):
+        for i in items:
+            buf = Buffer(i)
+            if buf.cmd == CommandId.APS_DATA_INDICATION:
+                buf.pop('<HB')
+                buf.pop_raw(len(buf))
+            else:
+                buf.pop('<B')
+        return len(items)
+    return frames, run
+
+
+def bench_message_from_buffer(n):
+    frames = [i for i in make_frames(n * 2) if i[0] == CommandId.APS_DATA_INDICATION.value][:n]
+
+    def run(items):
+        for i in items:
+            Message.from_buffer(Buffer(i))
+        return len(items)
+    return frames, run
+
+
+def bench_slip_decode(n):
+    chunks = make_stream(make_frames(n))
+
+    def run(items):
+        decoder = framing.FrameDecoder()
+        count = 0
+        for i in items:
+            for _ in decoder.feed(i):
+                count += 1
+        return count
+    return chunks, run
+
+
+def bench_data_received(n):
+    chunks = make_stream(make_frames(n))
+    conn = _connection()
+
+    def run(items):
+        before = conn._decoder.frames
+        for i in items:
+            conn.data_received(i)
+        return conn._decoder.frames - before
+    return chunks, run
+
+
+def bench_send_encode(n):
+    messages = make_messages(n)
+    conn = _connection()
+
+    def run(items):
+        for msg in items:
+            conn._send_command(protocol.encode(
+                CommandId.APS_DATA_REQUEST, msg.request_id, msg.request_id, 0, msg.dest, msg.profile_id,
+                msg.cluster_id, msg.src.endpoint, msg.data))
+        conn._out.clear()
+        return len(items)
+    return messages, run
+
+
+BENCHMARKS = {
+    'crc': bench_crc,
+    'buffer': bench_buffer,
+    'message_from_buffer': bench_message_from_buffer,
+    'slip_decode': bench_slip_decode,
+    'data_received': bench_data_received,
+    'send_encode': bench_send_encode,
+}
+
+
+def measure(factory, frames, repeat):
+    # type: (typing.Callable, int, int) -> dict
+    items, run = factory(frames)
+
+    # best of `repeat` runs, like timeit
+    best = None
+    count = 0
+    blocks_before = sys.getallocatedblocks()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            t = time.perf_counter_ns()
+            count = run(items)
+            elapsed = time.perf_counter_ns() - t
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        gc.enable()
+    gc.collect()
+    retained = (sys.getallocatedblocks() - blocks_before) / (count * repeat)
+
+    # allocation peak per item, on a sample
+    sample = items[:min(len(items), 200)]
+    tracemalloc.start()
+    try:
+        total = 0
+        sample_count = 0
+        for i in sample:
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            sample_count += run([i])
+            total += tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'frames': count,
+        'frames_per_sec': count / (best / 1e9),
+        'ns_per_frame': best / count,
+        'alloc_bytes': total / max(sample_count, 1),
+        'retained_blocks': retained,
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    # type: (dict, dict, float) -> typing.List[str]
+    regressions = []
+    for name, res in results['benchmarks'].items():
+        old = baseline['benchmarks'].get(name)
+        if old is None:
+            continue
+        change = res['ns_per_frame'] / old['ns_per_frame'] - 1
+        line = '%-20s %10.0f -> %10.0f ns/frame (%+.1f%%)' % (name, old['ns_per_frame'], res['ns_per_frame'], change * 100)
+        if change > threshold:
+            regressions.append(name)
+            line += '  REGRESSION'
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the frame encoding and decoding hot paths")
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help="benchmarks to run, all by default: %s" % ', '.join(BENCHMARKS))
+    parser.add_argument('--frames', type=int, default=10000, help="frames per run")
+    parser.add_argument('--repeat', type=int, default=5, help="runs per benchmark, the fastest one counts")
+    parser.add_argument('--output', default='benchmark.json', help="file to write the results to")
+    parser.add_argument('--compare', metavar='BASELINE', help="results of an earlier run to compare with")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="slowdown counted as a regression, 0.1 is 10%%")
+    args = parser.parse_args()
+    for i in args.benchmarks:
+        if i not in BENCHMARKS:
+            parser.error("unknown benchmark %s" % i)
+
+    logging.basicConfig(format='[%(asctime)s] %(message)s')
+    # the library logs every frame, that's not what we measure here
+    logging.getLogger('pyconz').setLevel(logging.ERROR)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    results = {
+        'time': time.time(),
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'frames': args.frames,
+        'repeat': args.repeat,
+        'benchmarks': {},
+    }
+    for name in args.benchmarks or BENCHMARKS:
+        res = measure(BENCHMARKS[name], args.frames, args.repeat)
+        results['benchmarks'][name] = res
+        print('%-20s %12.0f frames/s %10.0f ns/frame %8.0f B/frame %6.2f retained' % (
+            name, res['frames_per_sec'], res['ns_per_frame'], res['alloc_bytes'], res['retained_blocks']))
+    loop.close()
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
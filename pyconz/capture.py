@@ -0,0 +1,213 @@
+"""
+Recording and replaying raw serial traffic.
+
+A capture file starts with an 8 byte magic and the wall clock start time (little endian double),
+followed by records of a '<QBH' header (microseconds since the start, direction, data length)
+and the data itself.
+
+`FlightRecorder` keeps the most recent frames in memory instead, to be dumped when something goes wrong.
+"""
+import asyncio
+import binascii
+import collections
+import logging
+import mmap
+import struct
+import time
+import typing
+
+MAGIC = b'PCZCAP01'
+DEVICE_TO_HOST = 0
+HOST_TO_DEVICE = 1
+# flight recorder entries of decoded frames
+DECODED = 2
+
+FLIGHT_RECORDER_SIZE = 256
+
+_file_header = struct.Struct('<8sd')
+_record_header = struct.Struct('<QBH')
+
+Record = collections.namedtuple('Record', ['timestamp', 'direction', 'data'])
+
+
+class CaptureWriter:
+    def __init__(self, path):
+        # type: (str) -> None
+        self._file = open(path, 'wb')
+        self._start = time.monotonic()
+        self._file.write(_file_header.pack(MAGIC, time.time()))
+
+    def record(self, direction, data):
+        # type: (int, bytes) -> None
+        ts = int((time.monotonic() - self._start) * 1e6)
+        view = memoryview(data)
+        # the length field is 16 bit, bigger chunks are split
+        for i in range(0, len(view), 0xffff):
+            chunk = view[i:i + 0xffff]
+            self._file.write(_record_header.pack(ts, direction, len(chunk)))
+            self._file.write(chunk)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class CaptureReader:
+    """
+    Reads a capture through a memory map, record data are views into the map
+    """
+
+    def __init__(self, path):
+        # type: (str) -> None
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        magic, self.start_time = _file_header.unpack_from(self._view, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("%s is not a capture file" % path)
+
+    def __iter__(self):
+        # type: () -> typing.Iterator[Record]
+        view = self._view
+        pos = _file_header.size
+        end = len(view)
+        while pos + _record_header.size <= end:
+            ts, direction, length = _record_header.unpack_from(view, pos)
+            pos += _record_header.size
+            if pos + length > end:
+                # truncated by a crash while recording
+                return
+            yield Record(ts / 1e6, direction, view[pos:pos + length])
+            pos += length
+
+    def close(self):
+        self._view.release()
+        try:
+            self._map.close()
+        except BufferError:
+            # record views are still alive, the map goes away with the last of them
+            pass
+
+
+class ReplayTransport(asyncio.Transport):
+    """
+    Feeds the device side of a capture into a protocol, e.g. any `SerialConnection`.
+
+    With `realtime` the chunks are delivered with their original spacing, otherwise as fast as
+    possible while still letting the event loop run between chunks. Writes from the protocol are
+    only counted. `done` resolves with the number of replayed chunks.
+    """
+
+    def __init__(self, path, protocol, realtime=False):
+        # type: (str, asyncio.Protocol, bool) -> None
+        super().__init__()
+        self._loop = asyncio.get_event_loop()
+        self._reader = CaptureReader(path)
+        self._records = (i for i in self._reader if i.direction == DEVICE_TO_HOST)
+        self._protocol = protocol
+        self._realtime = realtime
+        self._closing = False
+        self._t0 = None     # type: float
+        # the delivery of the next record in realtime mode
+        self._timer = None  # type: asyncio.TimerHandle
+        self.replayed = 0
+        self.bytes_written = 0
+        self.done = asyncio.Future()
+        self._loop.call_soon(self._start)
+
+    def _start(self):
+        self._t0 = self._loop.time()
+        self._protocol.connection_made(self)
+        self._feed_next()
+
+    def _feed_next(self):
+        if self._closing:
+            return
+        rec = next(self._records, None)
+        if rec is None:
+            self.close()
+            return
+        if self._realtime:
+            self._timer = self._loop.call_at(self._t0 + rec.timestamp, self._deliver, rec)
+        else:
+            self._deliver(rec)
+
+    def _deliver(self, rec):
+        # type: (Record) -> None
+        self._timer = None
+        if self._closing:
+            return
+        self._protocol.data_received(bytes(rec.data))
+        self.replayed += 1
+        self._loop.call_soon(self._feed_next)
+
+    def write(self, data):
+        self.bytes_written += len(data)
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        if self._timer is not None:
+            # the pending record is a view into the capture, it would keep it from being closed
+            self._timer.cancel()
+            self._timer = None
+        self._records.close()
+        self._reader.close()
+        self._protocol.connection_lost(None)
+        if not self.done.done():
+            self.done.set_result(self.replayed)
+
+
+class FlightRecorder:
+    """
+    Ring buffer of the last `size` frames and decode results.
+
+    Recording only stores a reference, formatting happens in `dump`. A size of 0 turns it off.
+    """
+
+    _directions = {DEVICE_TO_HOST: '<-', HOST_TO_DEVICE: '->', DECODED: '  '}
+
+    def __init__(self, size=FLIGHT_RECORDER_SIZE):
+        # type: (int) -> None
+        self._entries = collections.deque(maxlen=size)    # type: typing.Deque[Record]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def record(self, direction, data):
+        # type: (int, typing.Any) -> None
+        """
+        `data` is a frame for DEVICE_TO_HOST and HOST_TO_DEVICE, anything printable for DECODED
+        """
+        self._entries.append(Record(time.monotonic(), direction, data))
+
+    def clear(self):
+        self._entries.clear()
+
+    def format(self):
+        # type: () -> typing.List[str]
+        if not self._entries:
+            return []
+        end = self._entries[-1].timestamp
+        ret = []
+        for ts, direction, data in self._entries:
+            if direction == DECODED:
+                text = str(data)
+            else:
+                text = binascii.hexlify(data).decode()
+            ret.append('%9.3f %s %s' % (ts - end, self._directions[direction], text))
+        return ret
+
+    def dump(self, log, level=logging.ERROR):
+        # type: (logging.Logger, int) -> None
+        log.log(level, "Last %d frames (seconds before the last one):\n%s", len(self._entries), '\n'.join(self.format()))
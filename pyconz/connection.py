@@ -2,22 +2,83 @@ import logging
 import serial
 import serial.aio
 import asyncio
-import sliplib
 from .protocol import *
 from . import protocol
 from .utils import Buffer
+from . import framing
+from .framing import FrameDecoder
+from . import capture
+from .metrics import ConnectionMetrics
+from .subscription import Subscription, OverflowPolicy
+from .correlation import CorrelationTable
 import binascii
+import functools
+import heapq
+import itertools
 import os
 import typing
 
 logger = logging.getLogger(__name__)
 
-
-Address = collections.namedtuple('Address', ['mode', 'addr', 'endpoint'])
-Address.__str__ = lambda a: '%x.%02x (%s)' % (a.addr, a.endpoint, a.mode)
+# how often to ask for the device state while APS requests are waiting for a free slot
+DEV_STATE_POLL_INTERVAL = 0.1
+# an APS_DATA_REQUEST not acknowledged within this time is considered lost
+APS_REQUEST_ACK_TIMEOUT = 2.0
+# default time to wait for a response to any other request
+REQUEST_TIMEOUT = 5.0
+# time to wait for the radio to confirm a sent APS frame
+APS_CONFIRM_TIMEOUT = 10.0
+# errors dump the flight recorder at most this often
+RECORDER_DUMP_INTERVAL = 60.0
+# most messages passed to handle_incoming_messages at once with batch_delivery
+MAX_BATCH = 64
+
+
+def _retrieve_exception(fut: asyncio.Future):
+    # nobody has to await a request, don't let asyncio complain about unretrieved timeouts
+    if not fut.cancelled():
+        fut.exception()
+
+
+class SendPriority(enum.IntEnum):
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+class PendingSend:
+    """
+    An APS frame on its way out. `enqueued_at`, `sent_at`, `acked_at` and `confirmed_at` are event loop
+    timestamps of `send_msg`, of writing the request, of the serial ack and of the APS_DATA_CONFIRM.
+    """
+
+    def __init__(self, msg, future, enqueued_at):
+        self.msg = msg  # type: Message
+        self.future = future    # type: asyncio.Future
+        self.enqueued_at = enqueued_at  # type: float
+        self.sent_at = None     # type: float
+        self.acked_at = None    # type: float
+        self.confirmed_at = None    # type: float
+        self.confirm_status = None  # type: int
+        self.timeout_handle = None  # type: asyncio.TimerHandle
+
+    @property
+    def queue_delay(self):
+        # time spent waiting for a free request slot in the device
+        return self.sent_at - self.enqueued_at
+
+    @property
+    def radio_delay(self):
+        # time between the device accepting the frame and confirming the transmission
+        return self.confirmed_at - self.acked_at
+
+    @property
+    def latency(self):
+        return self.confirmed_at - self.enqueued_at
 
 
 class Message:
+    __slots__ = ('src', 'dest', 'data', 'profile_id', 'cluster_id', 'request_id')
+
     def __init__(self):
         self.src = None     # type: Address
         self.dest = None    # type: Address
@@ -28,33 +89,19 @@ class Message:
 
     @staticmethod
     def from_buffer(buf: Buffer):
-        pl_len = buf.pop_int('<H')
-        dev_st = buf.pop_int('B')
-
-        dest_addr_mode = buf.pop_enum('B', AddressType)
-        dest_addr = buf.pop('<H' if dest_addr_mode in [AddressType.Group, AddressType.NWK] else '<Q')[0]
-        dest_endpoint = buf.pop_int('B')
-        src_addr_mode = buf.pop_enum('B', AddressType)
-        assert src_addr_mode != AddressType.Group   # not in the spec
-        src_addr = buf.pop('<H' if src_addr_mode == AddressType.NWK else '<Q')[0]
-
-        src_endpoint, profile_id, cluster_id = buf.pop('<BHH')
-        asdu_len = buf.pop_int('<H')
-        asdu = buf.pop_raw(asdu_len)
-        logger.warning('Data %x.%02d (%s) -> %x.%02d (%s), len %d, %s', src_addr, src_endpoint, src_addr_mode, dest_addr, dest_endpoint, dest_addr_mode, asdu_len, binascii.hexlify(asdu).decode())
-        buf.pop('<BB')
-        lqi = buf.pop('<B')[0]
-        buf.pop('<BBBB')
-        rssi = buf.pop('<b')[0]
+        ind = protocol.decode(buf)
+        assert ind.src.mode != AddressType.Group   # not in the spec
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Data %s -> %s, len %d, %s', ind.src, ind.dest, len(ind.data), binascii.hexlify(ind.data).decode())
 
         msg = Message()
-        msg.src = Address(src_addr_mode, src_addr, src_endpoint)
-        msg.dest = Address(dest_addr_mode, dest_addr, dest_endpoint)
-        msg.data = asdu
-        msg.cluster_id = cluster_id
-        msg.profile_id = profile_id
+        msg.src = ind.src
+        msg.dest = ind.dest
+        msg.data = ind.data
+        msg.cluster_id = ind.cluster_id
+        msg.profile_id = ind.profile_id
 
-        return msg, dev_st
+        return msg, ind.dev_st
 
     def deserialize(self):
         return 0, 0, 0, binascii.hexlify(self.data),
@@ -73,9 +120,22 @@ class SerialConnection:
     def __init__(self):
         super().__init__()
         self._transport = None  # type: serial.aio.SerialTransport
-        self._seq = 0
-        self._drv = sliplib.Driver()
+        self.request_timeout = REQUEST_TIMEOUT
+        self._free_seqs = collections.deque(range(256))     # type: typing.Deque[int]
+        self._seq_waiters = collections.deque()     # requests waiting for a free sequence number
+        self._decoder = FrameDecoder(self._handle_invalid_frame)
+        self._out = []          # type: typing.List[bytes]
+        self._flush_scheduled = False
+        self._writing_paused = False
+        self._drain_waiter = None   # type: asyncio.Future
+        self.capture = None     # type: capture.CaptureWriter
+        self.recorder = capture.FlightRecorder()
+        self._recorder_dumped_at = None     # type: typing.Optional[float]
         self.logger = logger
+        self.metrics = ConnectionMetrics()
+        # command and send time of the request using each sequence number, for the latency histograms
+        self._request_cmds = [None] * 256   # type: typing.List[CommandId]
+        self._request_times = [0.0] * 256
         self._msg_handlers = {
             CommandId.DEVICE_STATE: self._handle_dev_state,
             CommandId.DEVICE_STATE_CHANGED: self._handle_dev_state_changed,
@@ -84,218 +144,589 @@ class SerialConnection:
             CommandId.READ_PARAMETER: self._handle_get_parameter_response,
             CommandId.WRITE_PARAMETER: self._handle_set_parameter_response,
             CommandId.APS_DATA_REQUEST: self._handle_data_request_response,
+            CommandId.CHANGE_NETWORK_STATE: self._handle_network_state_response,
+            CommandId.APS_DATA_CONFIRM: self._handle_data_confirm,
         }
-        self._requests = {}     # type: typing.Dict[int, asyncio.Future]
-        self.zigpy_futures = {}
+        # futures of the requests waiting for a response, by sequence number
+        self._requests = CorrelationTable(self._request_expired)
+
+        # parameter values stay valid until the device reports CONF_CHANGED
+        self._parameters = {}   # type: typing.Dict[NetworkParameter, typing.Any]
+        self._parameter_reads = {}  # type: typing.Dict[NetworkParameter, asyncio.Future]
+        self._parameters_generation = 0
+        # bumped by every write, so a read that was in flight doesn't cache the value from before it
+        self._parameter_writes = collections.Counter()  # type: typing.Dict[NetworkParameter, int]
+
+        # at most one APS_DATA_INDICATION read is outstanding, the next one goes out as soon as
+        # the state piggybacked on the previous indication says there is more
+        self._indication_read = None    # type: asyncio.Future
+        self._drain_started = None      # type: typing.Optional[float]
+        self._drain_count = 0
+        self.indications_received = 0
+        self.last_drain_rate = None     # type: typing.Optional[float]
+
+        # with batch_delivery the messages of one drain go to handle_incoming_messages together, at most
+        # max_batch of them, so continuous traffic doesn't hold them back forever
+        self.batch_delivery = False
+        self.max_batch = MAX_BATCH
+        self._batch = None  # type: typing.Optional[typing.List[Message]]
+        self._subscriptions = []    # type: typing.List[Subscription]
+        # the last device state said it has indications for us
+        self._indications_waiting = False
+
+        # APS_DATA_REQUEST frames wait here for the device to report a free request slot
+        self._aps_queue = []    # type: typing.List[typing.Tuple[int, int, PendingSend]]
+        self._aps_counter = itertools.count()
+        self._aps_in_flight = {}    # type: typing.Dict[int, typing.Tuple[int, int, PendingSend]]
+        # accepted by the device, waiting for APS_DATA_CONFIRM
+        self._aps_unconfirmed = {}  # type: typing.Dict[int, PendingSend]
+        self._confirm_read = None   # type: asyncio.Future
+        self._aps_credits = 0
+        self._dev_state_poll = None     # type: asyncio.Handle
+
+        self.metrics.gauges.update({
+            'pending_requests': lambda: len(self._requests),
+            'held_requests': lambda: len(self._seq_waiters),
+            'queued_aps_requests': lambda: len(self._aps_queue),
+            'unconfirmed_aps_requests': lambda: len(self._aps_unconfirmed),
+        })
 
     def _handle_data_request_response(self, buf):
-        self.logger.info("APS_DATA_REQUEST result: %s", buf.status)
+        self.logger.debug("APS_DATA_REQUEST result: %s", buf.status)
+        rsp = protocol.decode(buf)
+        fut = self._complete_request(buf.seq)
+        if fut is not None and not fut.done():
+            fut.set_result(buf.status)
+        entry = self._aps_in_flight.pop(buf.seq, None)
+        if entry is not None:
+            send = entry[2]
+            if buf.status == Status.SUCCESS:
+                send.acked_at = asyncio.get_event_loop().time()
+                old = self._aps_unconfirmed.get(rsp.request_id)
+                if old is not None and old is not send:
+                    self.metrics.request_id_evictions += 1
+                    self._fail_send(old, RuntimeError("APS request id %d reused before confirmation" % rsp.request_id))
+                self._aps_unconfirmed[rsp.request_id] = send
+            elif buf.status == Status.BUSY:
+                # keeps its original place in the queue
+                heapq.heappush(self._aps_queue, entry)
+            else:
+                self._fail_send(send, RuntimeError("APS_DATA_REQUEST failed: %s" % buf.status))
+        self._handle_dev_state_value(rsp.dev_st)
+
+    def request_data_confirm(self):
+        if self._confirm_read is None:
+            self._confirm_read = self._request(CommandId.APS_DATA_CONFIRM)
+            self._confirm_read.add_done_callback(self._confirm_read_done)
+        return self._confirm_read
+
+    def _confirm_read_done(self, fut):
+        if self._confirm_read is fut:
+            self._confirm_read = None
+
+    def _handle_data_confirm(self, buf: Buffer):
+        f = self._complete_request(buf.seq)
+        if f is not None:
+            if f is self._confirm_read:
+                self._confirm_read = None
+            if not f.done():
+                f.set_result(buf.status)
+        if buf.status != Status.SUCCESS:
+            self.logger.warning("APS_DATA_CONFIRM with status %s", buf.status)
+            return
+        rsp = protocol.decode(buf)
+        send = self._aps_unconfirmed.pop(rsp.request_id, None)
+        if send is None:
+            self.logger.warning("No pending send for APS confirm %d (status 0x%02x)", rsp.request_id, rsp.confirm_status)
+        else:
+            send.confirmed_at = asyncio.get_event_loop().time()
+            send.confirm_status = rsp.confirm_status
+            send.timeout_handle.cancel()
+            if not send.future.done():
+                send.future.set_result(send)
+        self._handle_dev_state_value(rsp.dev_st)
+
+    def _fail_send(self, send, exc):
+        # type: (PendingSend, Exception) -> None
+        send.timeout_handle.cancel()
+        if self._aps_unconfirmed.get(send.msg.request_id) is send:
+            del self._aps_unconfirmed[send.msg.request_id]
+        if not send.future.done():
+            send.future.set_exception(exc)
+
+    def _send_timed_out(self, send):
+        # type: (PendingSend) -> None
+        self.logger.error("APS request %d was not confirmed", send.msg.request_id)
+        self._fail_send(send, TimeoutError("APS request %d was not confirmed" % send.msg.request_id))
 
     def eof_received(self):
         logging.error("EOF")
 
     async def read_all_parameters(self):
-        data = {}
-        for p in NetworkParameter:
-            data[p] = await self.get_parameter(p)
+        # all reads go out in one burst
+        params = list(NetworkParameter)
+        values = await asyncio.gather(*[self.get_parameter(p) for p in params])
+        data = dict(zip(params, values))
         self.logger.warning("Read device parameters:")
-        for i in sorted(data):
+        for i in params:
             self.logger.warning('%s = %s', i, data[i])
         return data
 
     def get_parameter(self, p):
         # type: (protocol.NetworkParameter) -> asyncio.Future
-        ret = asyncio.Future()
-        seq = self._next_seq()
-        req = struct.pack('<BBBHHB', 0x0a, seq, 0, 8, 1, p.value)
-        self._requests[seq] = ret
-        self._send_command(req)
+        """
+        Cached values are returned without asking the device, concurrent reads of a parameter share one request
+        """
+        if p in self._parameters:
+            ret = asyncio.Future()
+            ret.set_result(self._parameters[p])
+            return ret
+        ret = self._parameter_reads.get(p)
+        if ret is None:
+            ret = self._request(CommandId.READ_PARAMETER, p)
+            self._parameter_reads[p] = ret
+            ret.add_done_callback(functools.partial(self._parameter_read_done, p, self._parameter_generation(p)))
         return ret
 
+    def _parameter_generation(self, p):
+        return self._parameters_generation, self._parameter_writes[p]
+
+    def _parameter_read_done(self, p, generation, fut):
+        if self._parameter_reads.get(p) is fut:
+            del self._parameter_reads[p]
+        # a value read before the cache was invalidated or the parameter written may already be stale
+        if generation == self._parameter_generation(p) and not fut.cancelled() and fut.exception() is None:
+            self._parameters[p] = fut.result()
+
+    def invalidate_parameters(self):
+        self._parameters.clear()
+        self._parameter_reads.clear()
+        self._parameters_generation += 1
+
     def _handle_get_parameter_response(self, buf: Buffer):
-        seq = buf.seq
-        pl_len = buf.pop_int('<H')
-        param = buf.pop_enum('B', NetworkParameter)
-        p_type = param_types[param]     # type: protocol.NetworkParamInfo
-        data = buf.pop_int(p_type.format)
-        self.logger.warning("Got parameter value %s = %x", param, data)
-        try:
-            f = self._requests[seq]
-            f.set_result(data)
-            del self._requests[seq]
-        except KeyError:
-            pass
+        rsp = protocol.decode(buf)
+        self.logger.info("Got parameter value %s = %x", rsp.param, rsp.value)
+        f = self._complete_request(buf.seq)
+        if f is not None and not f.done():
+            f.set_result(rsp.value)
 
     def set_parameter(self, p, v):
         # type: (protocol.NetworkParameter, typing.Any) -> asyncio.Future
-        p_type = param_types[p]
-        seq = self._next_seq()
-        pl = struct.pack(p_type.format, v)
-        hdr = struct.pack('<BBBHHB', protocol.CommandId.WRITE_PARAMETER.value, seq, 0, len(pl) + 8, len(pl) + 1, p.value)
-        ret = asyncio.Future()
-        self._requests[seq] = ret
-        self._send_command(hdr + pl)
-        return ret
+        self._parameters.pop(p, None)
+        self._parameter_reads.pop(p, None)
+        self._parameter_writes[p] += 1
+        return self._request(CommandId.WRITE_PARAMETER, p, v)
 
     def _handle_set_parameter_response(self, buf: Buffer):
-        seq = buf.seq
-        pl_len = buf.pop_int('<H')
-        param = buf.pop_enum('B', NetworkParameter)
-        p_type = param_types[param]     # type: protocol.NetworkParamInfo
-        data = buf.pop_int(p_type.format)
+        rsp = protocol.decode(buf)
         status = buf.status
-        self.logger.warning("Status for writing %s: %s", param, status)
-        try:
-            f = self._requests[seq]
+        self.logger.warning("Status for writing %s: %s", rsp.param, status)
+        f = self._complete_request(buf.seq)
+        if f is not None and not f.done():
             if status == protocol.Status.SUCCESS:
-                f.set_result()
+                f.set_result(None)
             else:
                 f.set_exception(RuntimeError("Error %s" % status))
-            del self._requests[seq]
-        except KeyError:
-            pass
 
     def set_network_state(self, state=protocol.NetworkState.CONNECTED):
+        return self._request(CommandId.CHANGE_NETWORK_STATE, state)
+
+    def _handle_network_state_response(self, buf: Buffer):
+        rsp = protocol.decode(buf)
+        self.logger.warning("Network state change to %s: %s", rsp.state, buf.status)
+        f = self._complete_request(buf.seq)
+        if f is not None and not f.done():
+            f.set_result(buf.status)
+
+    def _request(self, cmd, *args, timeout=None):
+        # type: (CommandId, ..., typing.Optional[float]) -> asyncio.Future
+        """
+        Sends a request, or holds it back while all sequence numbers are in use.
+        The returned future gets the response or fails with TimeoutError.
+        """
+        fut = asyncio.Future()
+        fut.add_done_callback(_retrieve_exception)
+        if self._free_seqs:
+            self._send_request(fut, cmd, args, timeout)
+        else:
+            if not self._seq_waiters:
+                self.logger.warning("All sequence numbers are in use, holding requests back")
+            self.metrics.seq_exhausted += 1
+            self._seq_waiters.append((fut, cmd, args, timeout))
+        return fut
+
+    def _send_request(self, fut, cmd, args, timeout=None):
+        # type: (asyncio.Future, CommandId, tuple, typing.Optional[float]) -> int
         seq = self._next_seq()
-        msg = struct.pack(
-            '<BBBHB',
-            protocol.CommandId.CHANGE_NETWORK_STATE.value,
-            seq,
-            0,
-            6, state.value)
-        self._send_command(msg)
+        self._request_cmds[seq] = cmd
+        self._request_times[seq] = asyncio.get_event_loop().time()
+        self._requests.add(seq, timeout if timeout is not None else self.request_timeout, fut)
+        self._send_command(protocol.encode(cmd, seq, *args))
+        return seq
 
     def _next_seq(self):
-        self._seq += 1
-        self._seq = self._seq % 256
-        if self._seq in self._requests:
-            self.logger.error("Have to reuse request id %d", self._seq)
-            self._requests[self._seq].set_exception(TimeoutError("No response received, have to reuse request id"))
-            del self._requests[self._seq]
-        return self._seq
+        # released numbers go to the back, so a number is reused as late as possible
+        return self._free_seqs.popleft()
+
+    def _complete_request(self, seq):
+        # type: (int) -> typing.Optional[asyncio.Future]
+        """
+        Releases the sequence number of a pending request, returns its future or None if there was none
+        """
+        fut = self._requests.pop(seq)
+        if fut is None:
+            return None
+        self.metrics.request_latency[self._request_cmds[seq]].observe(
+            asyncio.get_event_loop().time() - self._request_times[seq])
+        self._release_seq(seq)
+        return fut
+
+    def _release_seq(self, seq):
+        self._free_seqs.append(seq)
+        while self._seq_waiters and self._free_seqs:
+            self._send_request(*self._seq_waiters.popleft())
+        if self._aps_queue:
+            self._send_queued_requests()
+
+    def _request_expired(self, seq, fut):
+        # type: (int, asyncio.Future) -> None
+        self.logger.error("Request %d timed out", seq)
+        self.metrics.request_timeouts += 1
+        self._dump_recorder()
+        entry = self._aps_in_flight.pop(seq, None)
+        if entry is not None:
+            self._fail_send(entry[2], TimeoutError("APS request %d was not acknowledged" % entry[2].msg.request_id))
+        self._release_seq(seq)
+        if not fut.done():
+            fut.set_exception(TimeoutError("No response to request %d" % seq))
 
     def connection_made(self, transport: serial.aio.SerialTransport):
         self.logger.warning("Connection made: %s", transport)
         self._transport = transport
         self.do_hello()
 
+    def start_capture(self, path):
+        # type: (str) -> None
+        """
+        Records all serial traffic into a capture file, see `pyconz.capture`
+        """
+        self.stop_capture()
+        self.capture = capture.CaptureWriter(path)
+
+    def stop_capture(self):
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+
     def data_received(self, data):
-        msgs = self._drv.receive(data)
-        for i in msgs:
+        if self.capture is not None:
+            self.capture.record(capture.DEVICE_TO_HOST, data)
+        for i in self._decoder.feed(data):
             try:
                 self._handle_command(i)
             except:
                 self.logger.exception("Error while handling command %s", binascii.hexlify(i).decode())
+                self._dump_recorder()
+
+    def _dump_recorder(self):
+        now = asyncio.get_event_loop().time()
+        if self._recorder_dumped_at is None or now - self._recorder_dumped_at >= RECORDER_DUMP_INTERVAL:
+            self._recorder_dumped_at = now
+            self.recorder.dump(self.logger)
 
     def connection_lost(self, exc):
         self.logger.error("Connection lost")
+        self._transport = None
+        self._flush_batch()
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_exception(ConnectionError("Connection lost"))
+
+    def pause_writing(self):
+        self.logger.info("Transport buffer is full, pausing writes")
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self.logger.info("Resuming writes")
+        self._writing_paused = False
+        self._flush()
 
     def do_hello(self):
+        self.invalidate_parameters()
         self.request_dev_state()
         asyncio.ensure_future(self.startup())
 
+    async def startup(self):
+        pass
+
     def hard_reset(self):
         os.system('gpio write 0 0; sleep 2; gpio write 0 1')
-        self._drv = sliplib.Driver()
+        self._decoder.reset()
 
-    def _handle_command(self, buf):
-        self.logger.debug("Incoming serial message %s", binascii.hexlify(buf).decode())
+    def _handle_invalid_frame(self, buf):
+        # the firmware prints its banner as plain text, so it only shows up among frames failing the checksum
         if b'STARTING APP' in buf:
             self.logger.warning("Device [re]started")
             self.do_hello()
         else:
-            cksum = buf[-2:]
-            buf = buf[:-2]
-            if crc(buf) != cksum:
-                self.logger.error("CRC mismatch: %s, %s", binascii.hexlify(buf).decode(), binascii.hexlify(cksum).decode())
-                return
-            cmd = Buffer(buf)
-            if not isinstance(cmd.cmd, CommandId):
-                if cmd.cmd != 0x11111c:
-                    self.logger.warning("Unknown command id: %x", cmd.cmd)
-            elif cmd.cmd in self._msg_handlers:
-                self._msg_handlers[cmd.cmd](cmd)
-            else:
-                self.logger.warning("Ignoring unknown message (cmd id %s, %s)", cmd.cmd, binascii.hexlify(buf).decode())
+            self.metrics.crc_errors += 1
+            self.logger.error("CRC mismatch: %s", binascii.hexlify(buf).decode())
+
+    def _handle_command(self, buf):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Incoming serial message %s", binascii.hexlify(buf).decode())
+        self.recorder.record(capture.DEVICE_TO_HOST, buf)
+        self.metrics.frames_in[buf[0]] += 1
+        cmd = Buffer(buf)
+        if not isinstance(cmd.cmd, CommandId):
+            self.metrics.unknown_commands += 1
+            if cmd.cmd != 0x11111c:
+                self.logger.warning("Unknown command id: %x", cmd.cmd)
+        elif cmd.cmd in self._msg_handlers:
+            self._msg_handlers[cmd.cmd](cmd)
+        else:
+            self.metrics.unknown_commands += 1
+            self.logger.warning("Ignoring unknown message (cmd id %s, %s)", cmd.cmd, binascii.hexlify(buf).decode())
 
     def _handle_dev_state_value(self, state):
         flags = [i for i in DeviceState if (state & i.value) == i.value]
-        net_state = NetworkState(state & 3)
-        logger.info("Device state message: state = %d (net: %s, %s, %s)", state, net_state, bin(state), flags)
-        if DeviceState.APSDE_DATA_INDICATION in flags:
-            self.request_incoming_data()
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Device state message: state = %d (net: %s, %s, %s)", state, NetworkState(state & 3), bin(state), flags)
+        if DeviceState.CONF_CHANGED in flags and (self._parameters or self._parameter_reads):
+            self.logger.info("Device configuration changed, dropping cached parameters")
+            self.invalidate_parameters()
+        if DeviceState.APSDE_DATA_CONFIRM in flags:
+            self.request_data_confirm()
+        self._indications_waiting = DeviceState.APSDE_DATA_INDICATION in flags
+        if self._indications_waiting and not self._reading_blocked():
+            self._read_indications()
+        elif self._drain_started is not None and self._indication_read is None:
+            self._drain_finished()
+        # The firmware only tells whether it has room for another request, so we keep at most one
+        # request that it hasn't acknowledged yet.
+        if DeviceState.APSDE_DATA_REQUEST in flags and not self._aps_in_flight:
+            self._aps_credits = 1
+        else:
+            self._aps_credits = 0
+        self._send_queued_requests()
 
     def request_dev_state(self):
-        req = struct.pack('<BBBHBBB', protocol.CommandId.DEVICE_STATE.value, self._next_seq(), 0, 8, 0, 0, 0)
-        self._send_command(req)
+        return self._request(CommandId.DEVICE_STATE)
 
     def _handle_dev_state(self, buf: Buffer):
-        state = buf.pop_int('B')
+        state = protocol.decode(buf).state
+        f = self._complete_request(buf.seq)
+        if f is not None and not f.done():
+            f.set_result(state)
         self._handle_dev_state_value(state)
 
     def _handle_dev_state_changed(self, buf: Buffer):
-        state = buf.pop_int('B')
-        self._handle_dev_state_value(state)
+        self._handle_dev_state_value(protocol.decode(buf).state)
 
     def _handle_incoming_data(self, buf: Buffer):
+        f = self._complete_request(buf.seq)
+        if f is not None:
+            if f is self._indication_read:
+                # cleared right away, the piggybacked state below may need to start the next read
+                self._indication_read = None
+            if not f.done():
+                f.set_result(buf.status)
         if buf.status != Status.SUCCESS:
             self.logger.warning("Incoming data with status %s", buf.status)
+            # the device had nothing (more) to give, no state follows that could end the drain
+            if self._drain_started is not None and self._indication_read is None:
+                self._drain_finished()
+            self._flush_batch()
             return
+        self.indications_received += 1
+        self._drain_count += 1
         msg, dev_st = Message.from_buffer(buf)
+        self.recorder.record(capture.DECODED, msg)
+        for i in self._subscriptions:
+            i.offer(msg)
+        if self.batch_delivery:
+            if self._batch is None:
+                self._batch = []
+            self._batch.append(msg)
+            if len(self._batch) >= self.max_batch:
+                self._flush_batch()
+        else:
+            self._deliver(msg)
+        self._handle_dev_state_value(dev_st)
+        # the drain is over, or paused by a full subscription
+        if self._indication_read is None:
+            self._flush_batch()
+
+    def _flush_batch(self):
+        batch = self._batch
+        if not batch:
+            return
+        self._batch = None
+        try:
+            self.handle_incoming_messages(batch)
+        except:
+            self.logger.exception("Error while processing %d messages", len(batch))
+            self._dump_recorder()
+
+    def _deliver(self, msg):
         try:
             self.handle_incoming_message(msg)
         except:
             self.logger.exception("Error while processing message %s", msg)
-        self._handle_dev_state_value(dev_st)
+            self._dump_recorder()
 
     def handle_incoming_message(self, msg: Message):
         self.logger.warning("Unhandled message: %s", msg)
 
+    def handle_incoming_messages(self, msgs):
+        # type: (typing.List[Message]) -> None
+        """
+        Receives the messages of one drain when `batch_delivery` is on, passes them one by one
+        to `handle_incoming_message` unless overridden
+        """
+        for i in msgs:
+            self._deliver(i)
+
+    def messages(self, maxsize=1000, overflow=OverflowPolicy.DROP_OLDEST, cluster_id=None, profile_id=None, src=None,
+                 filter=None):
+        # type: (int, OverflowPolicy, ..., typing.Optional[typing.Callable[[Message], bool]]) -> Subscription
+        """
+        Subscribes to incoming messages: `async for msg in conn.messages(cluster_id=0x0402): ...`.
+
+        `cluster_id`, `profile_id` and `src` (NWK or IEEE address) take a value or a collection of
+        values, `filter` any predicate. Messages are queued independently of `handle_incoming_message`.
+        With `OverflowPolicy.BLOCK` a full queue stops reading indications from the device.
+        """
+        ret = Subscription(self, maxsize, overflow, cluster_id, profile_id, src, filter)
+        self._subscriptions.append(ret)
+        return ret
+
+    def _unsubscribe(self, sub):
+        # type: (Subscription) -> None
+        if sub in self._subscriptions:
+            self._subscriptions.remove(sub)
+            if sub.overflow == OverflowPolicy.BLOCK:
+                self._subscription_ready()
+
+    def _reading_blocked(self):
+        # type: () -> bool
+        for i in self._subscriptions:
+            if i.overflow == OverflowPolicy.BLOCK and i.full:
+                return True
+        return False
+
+    def _subscription_ready(self):
+        if self._indications_waiting and not self._reading_blocked():
+            self._read_indications()
+
+    def _read_indications(self):
+        if self._drain_started is None:
+            self._drain_started = asyncio.get_event_loop().time()
+            self._drain_count = 0
+        self.request_incoming_data()
+
     def request_incoming_data(self):
-        req_id = self._next_seq()
-        req = struct.pack(
-            '<BBBHH',
-            protocol.CommandId.APS_DATA_INDICATION.value,
-            req_id,
-            0,
-            7,
-            1,
-        )
-        self._send_command(req)
+        if self._indication_read is None:
+            self._indication_read = self._request(CommandId.APS_DATA_INDICATION)
+            self._indication_read.add_done_callback(self._indication_read_done)
+        return self._indication_read
+
+    def _indication_read_done(self, fut):
+        # only matters for reads that failed or timed out, answered ones are cleared by the handler
+        if self._indication_read is fut:
+            self._indication_read = None
+            # not counted as a drain, the next indication flag starts a new one
+            self._drain_started = None
+            self._flush_batch()
+
+    def _drain_finished(self):
+        elapsed = asyncio.get_event_loop().time() - self._drain_started
+        self._drain_started = None
+        self.metrics.drain_time.observe(elapsed)
+        if self._drain_count and elapsed > 0:
+            self.last_drain_rate = self._drain_count / elapsed
+            self.logger.info("Drained %d indications in %.3f s (%.1f/s)", self._drain_count, elapsed, self.last_drain_rate)
 
     def _send_command(self, buf):
-        self.logger.info("Sending message %s", binascii.hexlify(buf).decode())
-        pack = self._drv.send(buf + crc(buf))
-        self.logger.debug("Encoded message: %s", binascii.hexlify(pack).decode())
-        self._transport.write(bytes([0xC0]))
-        self._transport.write(pack)
-
-    def send_msg(self, msg: Message):
-        assert msg.dest.mode == AddressType.NWK
-        pl = struct.pack(
-            '<BBBHBHHBH',
-            msg.request_id,
-            0,
-            0x02,  # FIXME NWK
-            msg.dest.addr,
-            msg.dest.endpoint,
-            msg.profile_id,
-            msg.cluster_id,
-            msg.src.endpoint,
-            len(msg.data)
-        )
-        pl += msg.data
-        pl += struct.pack('<BB', 0, 5)
-        buf = struct.pack(
-            '<BBBHH',
-            0x12,
-            self._next_seq(),
-            0,
-            len(pl) + 7,
-            len(pl)
-
-        )
-        self._send_command(buf + pl)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Sending message %s", binascii.hexlify(buf).decode())
+        self.recorder.record(capture.HOST_TO_DEVICE, buf)
+        self.metrics.frames_out[buf[0]] += 1
+        pack = framing.encode(buf + crc(buf))
+        if self.capture is not None:
+            self.capture.record(capture.HOST_TO_DEVICE, pack)
+        self._out.append(pack)
+        if not self._flush_scheduled:
+            # everything queued during this loop iteration goes out in one write
+            self._flush_scheduled = True
+            asyncio.get_event_loop().call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if self._writing_paused or self._transport is None:
+            return
+        if self._out:
+            data = b''.join(self._out)
+            self._out.clear()
+            self._transport.write(data)
+        if not self._writing_paused and self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    async def drain(self):
+        """
+        Waits until all queued frames are handed over to the transport and it is not asking us to pause
+        """
+        while self._out or self._writing_paused:
+            if self._transport is None:
+                raise ConnectionError("Not connected")
+            if self._drain_waiter is None or self._drain_waiter.done():
+                self._drain_waiter = asyncio.Future()
+            await self._drain_waiter
+
+    def send_msg(self, msg: Message, priority=SendPriority.INTERACTIVE):
+        # type: (Message, SendPriority) -> asyncio.Future
+        """
+        Queues an APS frame. The returned future gets the `PendingSend` once the radio confirms the
+        transmission (check its `confirm_status`), or fails if the device rejects or never confirms it.
+
+        `msg.dest` can be a NWK address (including the BROADCAST_* ones), an IEEE address, or a group
+        address, whose endpoint is ignored: group frames reach every member endpoint.
+        """
+        if not isinstance(msg.dest.mode, AddressType):
+            raise ValueError("Invalid destination address %s" % (msg.dest, ))
+        loop = asyncio.get_event_loop()
+        fut = asyncio.Future()
+        fut.add_done_callback(_retrieve_exception)
+        send = PendingSend(msg, fut, loop.time())
+        send.timeout_handle = loop.call_later(APS_CONFIRM_TIMEOUT, self._send_timed_out, send)
+        heapq.heappush(self._aps_queue, (priority, next(self._aps_counter), send))
+        self._send_queued_requests()
+        return fut
+
+    def _send_queued_requests(self):
+        while self._aps_queue and self._aps_credits > 0 and self._free_seqs:
+            entry = heapq.heappop(self._aps_queue)
+            send = entry[2]
+            if send.future.done():
+                # timed out while waiting in the queue
+                continue
+            self._aps_credits -= 1
+            send.sent_at = asyncio.get_event_loop().time()
+            seq = self._send_aps_request(send.msg)
+            self._aps_in_flight[seq] = entry
+        if self._aps_queue and self._dev_state_poll is None:
+            self._dev_state_poll = asyncio.get_event_loop().call_later(DEV_STATE_POLL_INTERVAL, self._poll_dev_state)
+
+    def _poll_dev_state(self):
+        self._dev_state_poll = None
+        if self._aps_queue:
+            self.request_dev_state()
+
+    def _send_aps_request(self, msg: Message):
+        # type: (Message) -> int
+        args = (msg.request_id, 0, msg.dest, msg.profile_id, msg.cluster_id, msg.src.endpoint, msg.data)
+        fut = asyncio.Future()
+        fut.add_done_callback(_retrieve_exception)
+        return self._send_request(fut, CommandId.APS_DATA_REQUEST, args, APS_REQUEST_ACK_TIMEOUT)
 
     def ignore_message(self, buf):
         pass
@@ -0,0 +1,98 @@
+import asyncio
+import heapq
+import itertools
+import typing
+
+
+class CorrelationTable:
+    """
+    Futures of requests waiting for their replies, with a deadline each.
+
+    Keys are whatever identifies a reply, e.g. (device, endpoint, cluster, TSN). An entry goes away
+    when it is resolved or expires; expired futures fail with TimeoutError, or are passed to
+    `on_expire(key, future)` instead if given. A single timer is armed for the earliest deadline,
+    and the deadline heap is compacted when resolved entries pile up in it, so memory stays
+    proportional to the number of outstanding requests.
+    """
+
+    def __init__(self, on_expire=None):
+        # type: (typing.Optional[typing.Callable[[typing.Hashable, asyncio.Future], None]]) -> None
+        self.on_expire = on_expire
+        self._pending = {}  # type: typing.Dict[typing.Hashable, asyncio.Future]
+        # (deadline, counter, key, future)
+        self._deadlines = []    # type: typing.List[typing.Tuple[float, int, typing.Hashable, asyncio.Future]]
+        self._counter = itertools.count()
+        self._timer = None  # type: asyncio.TimerHandle
+        self._timer_at = 0.0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, key):
+        return key in self._pending
+
+    def add(self, key, timeout, fut=None):
+        # type: (typing.Hashable, float, typing.Optional[asyncio.Future]) -> asyncio.Future
+        """
+        Registers a request, with a new future unless one is given. A request still waiting under the
+        same key (its TSN wrapped around) can't be told apart from the new one any more and fails.
+        """
+        old = self._pending.pop(key, None)
+        if old is not None and not old.done():
+            old.set_exception(RuntimeError("Request %s superseded by a newer one with the same key" % (key, )))
+        if fut is None:
+            fut = asyncio.Future()
+        self._pending[key] = fut
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        heapq.heappush(self._deadlines, (deadline, next(self._counter), key, fut))
+        if len(self._deadlines) > 2 * len(self._pending) + 64:
+            self._compact()
+        if self._timer is None or deadline < self._timer_at:
+            self._arm(deadline)
+        return fut
+
+    def resolve(self, key, result):
+        # type: (typing.Hashable, typing.Any) -> bool
+        """
+        Completes the request waiting under `key`, returns False if there is none
+        """
+        fut = self._pending.pop(key, None)
+        if fut is None:
+            return False
+        if not fut.done():
+            fut.set_result(result)
+        return True
+
+    def pop(self, key):
+        # type: (typing.Hashable) -> typing.Optional[asyncio.Future]
+        """
+        Removes the request without completing its future
+        """
+        return self._pending.pop(key, None)
+
+    def _compact(self):
+        self._deadlines = [i for i in self._deadlines if self._pending.get(i[2]) is i[3]]
+        heapq.heapify(self._deadlines)
+
+    def _arm(self, deadline):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer_at = deadline
+        self._timer = asyncio.get_event_loop().call_at(deadline, self._expire)
+
+    def _expire(self):
+        self._timer = None
+        now = asyncio.get_event_loop().time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, _, key, fut = heapq.heappop(self._deadlines)
+            # entries of resolved requests are left in the heap and skipped here
+            if self._pending.get(key) is not fut:
+                continue
+            del self._pending[key]
+            if self.on_expire is not None:
+                self.on_expire(key, fut)
+            elif not fut.done():
+                fut.set_exception(TimeoutError("No reply to request %s" % (key, )))
+        if self._deadlines:
+            self._arm(self._deadlines[0][0])
@@ -0,0 +1,77 @@
+import logging
+import typing
+
+logger = logging.getLogger(__name__)
+
+END = b'\xc0'
+ESC = b'\xdb'
+ESC_END = b'\xdb\xdc'
+ESC_ESC = b'\xdb\xdd'
+
+# a frame can't be longer than this, anything bigger is line noise without END bytes
+MAX_FRAME_SIZE = 0x1000
+
+
+def check_crc(frame):
+    # type: (typing.Union[bytes, bytearray, memoryview]) -> bool
+    """
+    The checksum is the two's complement of the byte sum, so a valid frame (checksum included) sums up to 0
+    """
+    if len(frame) < 3:
+        return False
+    return (sum(frame[:-2]) + frame[-2] + (frame[-1] << 8)) & 0xffff == 0
+
+
+def encode(frame):
+    # type: (bytes) -> bytes
+    """
+    SLIP-encodes a frame that already has its checksum appended, including both END bytes
+    """
+    return END + frame.replace(ESC, ESC_ESC).replace(END, ESC_END) + END
+
+
+class FrameDecoder:
+    """
+    Incremental SLIP decoder with checksum verification.
+
+    Raw serial data is accumulated in one bytearray; `feed` yields memoryviews of complete frames
+    with the checksum stripped. Frames failing the checksum are passed to `invalid_frame_cb`.
+    """
+
+    def __init__(self, invalid_frame_cb=None):
+        # type: (typing.Optional[typing.Callable[[bytes], None]]) -> None
+        self._buf = bytearray()
+        self.invalid_frame_cb = invalid_frame_cb
+        self.frames = 0
+        self.crc_errors = 0
+
+    def reset(self):
+        del self._buf[:]
+
+    def feed(self, data):
+        # type: (bytes) -> typing.Iterator[memoryview]
+        buf = self._buf
+        buf += data
+        while True:
+            end = buf.find(END)
+            if end < 0:
+                if len(buf) > MAX_FRAME_SIZE:
+                    logger.error("No frame end in %d bytes, dropping them", len(buf))
+                    del buf[:]
+                return
+            if not end:
+                # frames are delimited by END on both sides, skip the empty ones in between
+                del buf[:1]
+                continue
+            frame = buf[:end]
+            # deleting from the front of a bytearray only moves its start pointer
+            del buf[:end + 1]
+            if ESC in frame:
+                frame = frame.replace(ESC_END, END).replace(ESC_ESC, ESC)
+            if not check_crc(frame):
+                self.crc_errors += 1
+                if self.invalid_frame_cb is not None:
+                    self.invalid_frame_cb(bytes(frame))
+                continue
+            self.frames += 1
+            yield memoryview(frame)[:-2]
@@ -0,0 +1,132 @@
+"""
+Counters and histograms of a `SerialConnection`, readable as a dict or in the Prometheus text format.
+
+Everything the receive path touches is allocated up front: counters per command id are lists
+indexed by the command byte and histograms have fixed buckets, so recording costs an index
+operation or a bisect.
+"""
+import bisect
+import typing
+from .protocol import CommandId
+
+# seconds, from a fast serial round trip to a drain of a full indication buffer
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _command_name(cmd):
+    # type: (int) -> str
+    try:
+        return CommandId(cmd).name
+    except ValueError:
+        return '0x%02x' % cmd
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        # type: (typing.Sequence[float]) -> None
+        self.buckets = tuple(buckets)
+        # the last slot counts values above the highest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # type: (float) -> None
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        # type: () -> dict
+        return {
+            'buckets': dict(zip(self.buckets + (float('inf'), ), self.counts)),
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class ConnectionMetrics:
+    """
+    `frames_in` and `frames_out` count frames per command byte. `gauges` maps names to functions
+    returning the current value, they are only called for a snapshot or export.
+    """
+
+    def __init__(self):
+        self.frames_in = [0] * 256
+        self.frames_out = [0] * 256
+        self.crc_errors = 0
+        self.unknown_commands = 0
+        self.request_timeouts = 0
+        # requests held back because all 256 sequence numbers were in use
+        self.seq_exhausted = 0
+        # APS sends given up because their request id was reused before the confirm arrived
+        self.request_id_evictions = 0
+        self.request_latency = {i: Histogram() for i in CommandId}   # type: typing.Dict[CommandId, Histogram]
+        self.drain_time = Histogram()
+        self.gauges = {}    # type: typing.Dict[str, typing.Callable[[], float]]
+
+    def snapshot(self):
+        # type: () -> dict
+        return {
+            'frames_in': {_command_name(n): v for n, v in enumerate(self.frames_in) if v},
+            'frames_out': {_command_name(n): v for n, v in enumerate(self.frames_out) if v},
+            'crc_errors': self.crc_errors,
+            'unknown_commands': self.unknown_commands,
+            'request_timeouts': self.request_timeouts,
+            'seq_exhausted': self.seq_exhausted,
+            'request_id_evictions': self.request_id_evictions,
+            'request_latency': {cmd.name: h.snapshot() for cmd, h in self.request_latency.items() if h.count},
+            'drain_time': self.drain_time.snapshot(),
+            'gauges': {name: f() for name, f in self.gauges.items()},
+        }
+
+    def prometheus(self, prefix='pyconz'):
+        # type: (str) -> str
+        """
+        Renders all metrics in the Prometheus text exposition format
+        """
+        lines = []
+
+        def header(name, kind, doc):
+            lines.append('# HELP %s_%s %s' % (prefix, name, doc))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+
+        def per_command(name, counts, doc):
+            header(name, 'counter', doc)
+            for n, v in enumerate(counts):
+                if v:
+                    lines.append('%s_%s{command="%s"} %d' % (prefix, name, _command_name(n), v))
+
+        def histogram(name, h, labels=''):
+            cumulative = 0
+            for bound, count in zip(h.buckets, h.counts):
+                cumulative += count
+                lines.append('%s_%s_bucket{%sle="%g"} %d' % (prefix, name, labels, bound, cumulative))
+            lines.append('%s_%s_bucket{%sle="+Inf"} %d' % (prefix, name, labels, h.count))
+            braces = '{%s}' % labels.rstrip(',') if labels else ''
+            lines.append('%s_%s_sum%s %r' % (prefix, name, braces, h.sum))
+            lines.append('%s_%s_count%s %d' % (prefix, name, braces, h.count))
+
+        per_command('frames_received_total', self.frames_in, "Frames received from the device")
+        per_command('frames_sent_total', self.frames_out, "Frames sent to the device")
+        for name, doc in [
+            ('crc_errors', "Frames failing the checksum"),
+            ('unknown_commands', "Frames with an unknown command id"),
+            ('request_timeouts', "Requests without a response in time"),
+            ('seq_exhausted', "Requests held back while all sequence numbers were in use"),
+            ('request_id_evictions', "APS sends failed because their request id was reused"),
+        ]:
+            header(name + '_total', 'counter', doc)
+            lines.append('%s_%s_total %d' % (prefix, name, getattr(self, name)))
+
+        header('request_latency_seconds', 'histogram', "Time from sending a request to its response")
+        for cmd, h in self.request_latency.items():
+            if h.count:
+                histogram('request_latency_seconds', h, 'command="%s",' % cmd.name)
+        header('drain_time_seconds', 'histogram', "Time to read all indications the device had buffered")
+        histogram('drain_time_seconds', self.drain_time)
+
+        for name, f in self.gauges.items():
+            header(name, 'gauge', name.replace('_', ' ').capitalize())
+            lines.append('%s_%s %r' % (prefix, name, f()))
+        return '\n'.join(lines) + '\n'
@@ -47,6 +47,25 @@ class AddressType(enum.Enum):
     IEEE = 3
 
 
+Address = collections.namedtuple('Address', ['mode', 'addr', 'endpoint'])
+
+
+def _format_address(a):
+    # the source of outgoing frames has no address, group destinations may have no endpoint
+    addr = '-' if a.addr is None else '%x' % a.addr
+    endpoint = '--' if a.endpoint is None else '%02x' % a.endpoint
+    return '%s.%s (%s)' % (addr, endpoint, a.mode)
+
+
+Address.__str__ = _format_address
+
+
+# NWK broadcast addresses
+BROADCAST_ALL = 0xffff
+BROADCAST_RX_ON_WHEN_IDLE = 0xfffd
+BROADCAST_ROUTERS = 0xfffc
+
+
 class ApsDesignedCoordinator(enum.Enum):
     Coordinator = 1
     Router = 0
@@ -75,10 +94,257 @@ param_types = {     # type: typing.Dict[NetworkParameter, NetworkParamInfo]
 
 def crc(s):
     # type: (bytes)->bytes
-    ret = 0
-    for i in s:
-        ret += i
-    c0 = (~(ret) + 1) & 0xff
-    c1 = ((~(ret) + 1) >> 8) & 0xff
-    ret = (c0 + (c1 << 8))
-    return struct.pack('H', ret)
\ No newline at end of file
+    return struct.pack('<H', -sum(s) & 0xffff)
+
+
+# Frame schemas.
+#
+# Every frame starts with the common header (command id, sequence number, status, frame length), most
+# of them followed by a payload length field. The rest of the frame is described by a list of fields.
+# A field kind is either a struct format character (padding like '2x' produces no value) or one of the
+# variable-length kinds below. Schemas are compiled once into precomputed structs, so encoding a
+# fixed-size frame is a single struct.pack call.
+
+ADDR_EP = 'addr_ep'     # address mode byte, 2 or 8 byte address, endpoint (absent for group addresses)
+DEST_ADDR_EP = 'dest_addr_ep'   # like ADDR_EP, but the endpoint is there for group addresses too
+ASDU = 'asdu'           # 2 byte length followed by the data
+PARAM_VALUE = 'param_value'     # value of the NetworkParameter in the preceding field
+
+REQUIRED = object()
+
+FrameField = collections.namedtuple('FrameField', ['name', 'kind', 'cls', 'default'])
+FrameField.__new__.__defaults__ = (None, REQUIRED)
+
+_header = struct.Struct('<BBBH')
+_u8 = struct.Struct('<B')
+_u16 = struct.Struct('<H')
+_addr_structs = {
+    AddressType.Group: struct.Struct('<H'),
+    AddressType.NWK: struct.Struct('<HB'),
+    AddressType.IEEE: struct.Struct('<QB'),
+}
+_group_ep_struct = struct.Struct('<HB')
+_param_structs = {p.value: struct.Struct('<' + info.format) for p, info in param_types.items()}
+
+# group frames have no endpoint, they are delivered to every endpoint of the group
+GROUP_ENDPOINT = 0xff
+
+
+def _is_padding(kind):
+    return kind.endswith('x')
+
+
+def _encode_addr_ep(addr, prev):
+    mode = AddressType(addr.mode)
+    if mode == AddressType.Group:
+        return _u8.pack(mode.value) + _addr_structs[mode].pack(addr.addr)
+    return _u8.pack(mode.value) + _addr_structs[mode].pack(addr.addr, addr.endpoint)
+
+
+def _decode_addr_ep(buf, prev):
+    mode = AddressType(buf.pop_struct(_u8)[0])
+    if mode == AddressType.Group:
+        return Address(mode, buf.pop_struct(_addr_structs[mode])[0], GROUP_ENDPOINT)
+    addr, endpoint = buf.pop_struct(_addr_structs[mode])
+    return Address(mode, addr, endpoint)
+
+
+def _encode_dest_addr_ep(addr, prev):
+    mode = AddressType(addr.mode)
+    if mode == AddressType.Group:
+        endpoint = GROUP_ENDPOINT if addr.endpoint is None else addr.endpoint
+        return _u8.pack(mode.value) + _group_ep_struct.pack(addr.addr, endpoint)
+    return _encode_addr_ep(addr, prev)
+
+
+def _decode_dest_addr_ep(buf, prev):
+    mode = AddressType(buf.pop_struct(_u8)[0])
+    return Address(mode, *buf.pop_struct(_group_ep_struct if mode == AddressType.Group else _addr_structs[mode]))
+
+
+def _encode_asdu(data, prev):
+    return _u16.pack(len(data)) + data
+
+
+def _decode_asdu(buf, prev):
+    # the only copy made while decoding: the payload outlives the frame buffer
+    return bytes(buf.pop_raw(buf.pop_struct(_u16)[0]))
+
+
+def _encode_param_value(value, prev):
+    return _param_structs[prev].pack(value)
+
+
+def _decode_param_value(buf, prev):
+    return buf.pop_struct(_param_structs[prev])[0]
+
+
+_variable_kinds = {
+    ADDR_EP: (_encode_addr_ep, _decode_addr_ep),
+    DEST_ADDR_EP: (_encode_dest_addr_ep, _decode_dest_addr_ep),
+    ASDU: (_encode_asdu, _decode_asdu),
+    PARAM_VALUE: (_encode_param_value, _decode_param_value),
+}
+
+
+class FrameSchema:
+    def __init__(self, cmd, fields, payload_len=True):
+        # type: (CommandId, typing.List[FrameField], bool) -> None
+        self.cmd = cmd
+        self.payload_len = payload_len
+        self.fields = [i for i in fields if not _is_padding(i.kind)]
+
+        defaults = []
+        for i in self.fields:
+            if i.default is not REQUIRED:
+                defaults.append(i.default)
+            elif defaults:
+                raise ValueError("%s: field %s without default follows fields with defaults" % (cmd, i.name))
+        self.frame = collections.namedtuple(
+            ''.join(i.capitalize() for i in cmd.name.split('_')),
+            [i.name for i in self.fields],
+            defaults=defaults)
+        self._enums = [(n, i.cls) for n, i in enumerate(self.fields) if i.cls is not None]
+
+        # Steps are either runs of fixed-size fields merged into one struct: (None, struct, value_count),
+        # or a single variable-length field: (kind, None, 1).
+        self._steps = []
+        fmt = ''
+        count = 0
+        for i in fields:
+            if i.kind in _variable_kinds:
+                if fmt:
+                    self._steps.append((None, struct.Struct('<' + fmt), count))
+                fmt = ''
+                count = 0
+                self._steps.append((i.kind, None, 1))
+            else:
+                fmt += i.kind
+                if not _is_padding(i.kind):
+                    count += 1
+        if fmt or not self._steps:
+            self._steps.append((None, struct.Struct('<' + fmt), count))
+
+        # fixed-size frames are packed together with the header in one go
+        self._fixed = None
+        self._fixed_lengths = ()
+        if len(self._steps) == 1 and self._steps[0][0] is None:
+            body_size = self._steps[0][1].size
+            if payload_len:
+                self._fixed = struct.Struct(_header.format + 'H' + self._steps[0][1].format[1:])
+                self._fixed_lengths = (self._fixed.size, body_size)
+            else:
+                self._fixed = struct.Struct(_header.format + self._steps[0][1].format[1:])
+                self._fixed_lengths = (self._fixed.size, )
+
+    def encode(self, seq, *args, status=0, **kwargs):
+        # type: (int, ..., int) -> bytes
+        values = list(self.frame(*args, **kwargs))
+        if isinstance(status, enum.Enum):
+            status = status.value
+        for n, cls in self._enums:
+            v = values[n]
+            if isinstance(v, enum.Enum):
+                values[n] = v.value
+
+        if self._fixed is not None:
+            return self._fixed.pack(self.cmd.value, seq, status, *self._fixed_lengths, *values)
+
+        parts = []
+        pos = 0
+        for kind, st, count in self._steps:
+            if st is not None:
+                parts.append(st.pack(*values[pos:pos + count]))
+            else:
+                parts.append(_variable_kinds[kind][0](values[pos], values[pos - 1] if pos else None))
+            pos += count
+        payload = b''.join(parts)
+        if self.payload_len:
+            return _header.pack(self.cmd.value, seq, status, len(payload) + 7) + _u16.pack(len(payload)) + payload
+        return _header.pack(self.cmd.value, seq, status, len(payload) + 5) + payload
+
+    def decode(self, buf):
+        """
+        Decodes the frame body from a `utils.Buffer` positioned right after the header
+        """
+        if self.payload_len:
+            buf.pop_struct(_u16)
+        values = []
+        for kind, st, count in self._steps:
+            if st is not None:
+                values.extend(buf.pop_struct(st))
+            else:
+                values.append(_variable_kinds[kind][1](buf, values[-1] if values else None))
+        for n, cls in self._enums:
+            values[n] = cls(values[n])
+        return self.frame._make(values)
+
+
+F = FrameField
+
+request_schemas = {     # type: typing.Dict[CommandId, FrameSchema]
+    i.cmd: i for i in [
+        FrameSchema(CommandId.DEVICE_STATE, [F('_', '3x')], payload_len=False),
+        FrameSchema(CommandId.CHANGE_NETWORK_STATE, [F('state', 'B', NetworkState)], payload_len=False),
+        FrameSchema(CommandId.READ_PARAMETER, [F('param', 'B', NetworkParameter)]),
+        FrameSchema(CommandId.WRITE_PARAMETER, [F('param', 'B', NetworkParameter), F('value', PARAM_VALUE)]),
+        FrameSchema(CommandId.APS_DATA_INDICATION, [F('flags', 'B', default=0)]),
+        FrameSchema(CommandId.APS_DATA_CONFIRM, []),
+        FrameSchema(CommandId.APS_DATA_REQUEST, [
+            F('request_id', 'B'),
+            F('flags', 'B'),
+            F('dest', ADDR_EP),
+            F('profile_id', 'H'),
+            F('cluster_id', 'H'),
+            F('src_endpoint', 'B'),
+            F('data', ASDU),
+            F('tx_options', 'B', default=0),
+            F('radius', 'B', default=5),
+        ]),
+    ]
+}
+
+response_schemas = {    # type: typing.Dict[CommandId, FrameSchema]
+    i.cmd: i for i in [
+        FrameSchema(CommandId.DEVICE_STATE, [F('state', 'B'), F('_', '2x')], payload_len=False),
+        FrameSchema(CommandId.DEVICE_STATE_CHANGED, [F('state', 'B')], payload_len=False),
+        FrameSchema(CommandId.CHANGE_NETWORK_STATE, [F('state', 'B', NetworkState)], payload_len=False),
+        FrameSchema(CommandId.READ_PARAMETER, [F('param', 'B', NetworkParameter), F('value', PARAM_VALUE)]),
+        FrameSchema(CommandId.WRITE_PARAMETER, [F('param', 'B', NetworkParameter)]),
+        FrameSchema(CommandId.APS_DATA_REQUEST, [F('dev_st', 'B'), F('request_id', 'B')]),
+        FrameSchema(CommandId.APS_DATA_CONFIRM, [
+            F('dev_st', 'B'),
+            F('request_id', 'B'),
+            F('dest', ADDR_EP),
+            F('src_endpoint', 'B'),
+            F('confirm_status', 'B'),
+        ]),
+        FrameSchema(CommandId.APS_DATA_INDICATION, [
+            F('dev_st', 'B'),
+            # indications report the endpoint a group frame was received on
+            F('dest', DEST_ADDR_EP),
+            F('src', ADDR_EP),
+            F('profile_id', 'H'),
+            F('cluster_id', 'H'),
+            F('data', ASDU),
+            F('_', '2x'),
+            F('lqi', 'B'),
+            F('_', '4x'),
+            F('rssi', 'b'),
+        ]),
+    ]
+}
+
+del F
+
+
+def encode(cmd, seq, *args, **kwargs):
+    # type: (CommandId, int, ...) -> bytes
+    return request_schemas[cmd].encode(seq, *args, **kwargs)
+
+
+def decode(buf):
+    """
+    Decodes the body of a response frame, `buf` is a `utils.Buffer` with the header already parsed
+    """
+    return response_schemas[buf.cmd].decode(buf)
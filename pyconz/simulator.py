@@ -0,0 +1,234 @@
+import asyncio
+import collections
+import itertools
+import logging
+import socket
+import struct
+import typing
+from . import framing
+from .protocol import *
+from . import protocol
+from .utils import Buffer
+
+logger = logging.getLogger(__name__)
+
+# buffer sizes of the real firmware are in this range
+INDICATION_SLOTS = 8
+REQUEST_SLOTS = 4
+# time between accepting an APS request and confirming its transmission
+TX_DELAY = 0.01
+
+COORDINATOR_IEEE = 0x00212effff017fe7
+DEVICE_IEEE_BASE = 0x00124b0000000000
+DEVICE_NWK_BASE = 0x1000
+
+# ZCL attribute report of a temperature measurement
+_report = struct.Struct('<BBBHBh')
+TEMPERATURE_CLUSTER = 0x0402
+
+Indication = collections.namedtuple('Indication', ['src', 'cluster_id', 'data', 'lqi', 'rssi'])
+
+
+class FirmwareSimulator(asyncio.Protocol):
+    """
+    Stand-in for the ConBee/RaspBee firmware speaking the serial protocol to a `SerialConnection`.
+
+    It answers parameter reads and writes, device state and network state requests, accepts APS
+    requests into `request_slots` (BUSY when they are full) and confirms them after `tx_delay`.
+    Virtual end devices added with `add_devices` report attributes; their frames wait in
+    `indication_slots` until the host reads them and are dropped when the slots are full.
+    `stats` counts what happened.
+    """
+
+    def __init__(self, indication_slots=INDICATION_SLOTS, request_slots=REQUEST_SLOTS, tx_delay=TX_DELAY):
+        self.transport = None   # type: asyncio.Transport
+        self.indication_slots = indication_slots
+        self.request_slots = request_slots
+        self.tx_delay = tx_delay
+        self.parameters = {
+            NetworkParameter.MAC_ADDR: COORDINATOR_IEEE,
+            NetworkParameter.NWK_PANID: 0x1a62,
+            NetworkParameter.NWK_ADDR: 0x0000,
+            NetworkParameter.NWK_EXTENDED_PANID: COORDINATOR_IEEE,
+            NetworkParameter.APS_DESIGNED_COORDINATOR: ApsDesignedCoordinator.Coordinator.value,
+            NetworkParameter.SECURITY_MODE: 3,
+        }
+        self.network_state = NetworkState.CONNECTED
+        # with this off, frames from the host are dropped unanswered
+        self.responding = True
+        self.stats = collections.Counter()
+
+        self._decoder = framing.FrameDecoder(self._invalid_frame)
+        self._seq = itertools.count()
+        self._indications = collections.deque()     # type: typing.Deque[Indication]
+        self._requests_pending = 0      # accepted, not confirmed yet
+        self._confirms = collections.deque()    # (request_id, dest, src_endpoint)
+        self._notified_state = None
+        self._traffic = []  # type: typing.List[asyncio.TimerHandle]
+        self._device_count = 0
+        self._handlers = {
+            CommandId.DEVICE_STATE: self._device_state,
+            CommandId.CHANGE_NETWORK_STATE: self._change_network_state,
+            CommandId.READ_PARAMETER: self._read_parameter,
+            CommandId.WRITE_PARAMETER: self._write_parameter,
+            CommandId.APS_DATA_REQUEST: self._data_request,
+            CommandId.APS_DATA_CONFIRM: self._data_confirm,
+            CommandId.APS_DATA_INDICATION: self._data_indication,
+        }
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.stop_traffic()
+
+    def data_received(self, data):
+        for frame in self._decoder.feed(data):
+            self.stats['frames_in'] += 1
+            if not self.responding:
+                self.stats['frames_ignored'] += 1
+                continue
+            buf = Buffer(frame)
+            handler = self._handlers.get(buf.cmd)
+            if handler is None:
+                self.stats['unknown_commands'] += 1
+                continue
+            handler(buf, protocol.request_schemas[buf.cmd].decode(buf))
+            self._notify_state()
+
+    def _invalid_frame(self, frame):
+        self.stats['crc_errors'] += 1
+
+    def _send(self, frame):
+        if self.transport is None:
+            return
+        self.stats['frames_out'] += 1
+        self.transport.write(framing.encode(frame + crc(frame)))
+
+    def _respond(self, buf, *args, status=Status.SUCCESS):
+        self._send(protocol.response_schemas[buf.cmd].encode(buf.seq, *args, status=status))
+
+    def state(self):
+        # type: () -> int
+        ret = self.network_state.value
+        if self._confirms:
+            ret |= DeviceState.APSDE_DATA_CONFIRM.value
+        if self._indications:
+            ret |= DeviceState.APSDE_DATA_INDICATION.value
+        if self._requests_pending < self.request_slots:
+            ret |= DeviceState.APSDE_DATA_REQUEST.value
+        return ret
+
+    def _notify_state(self):
+        state = self.state()
+        if state != self._notified_state:
+            self._notified_state = state
+            self._send(protocol.response_schemas[CommandId.DEVICE_STATE_CHANGED].encode(next(self._seq) & 0xff, state))
+
+    # host requests
+
+    def _device_state(self, buf, req):
+        self._respond(buf, self.state())
+
+    def _change_network_state(self, buf, req):
+        self.network_state = req.state
+        self._respond(buf, req.state)
+
+    def _read_parameter(self, buf, req):
+        self._respond(buf, req.param, self.parameters[req.param])
+
+    def _write_parameter(self, buf, req):
+        self.parameters[req.param] = req.value
+        self._respond(buf, req.param)
+
+    def _data_request(self, buf, req):
+        if self._requests_pending >= self.request_slots:
+            self.stats['requests_busy'] += 1
+            self._respond(buf, self.state(), req.request_id, status=Status.BUSY)
+            return
+        self.stats['requests_accepted'] += 1
+        self._requests_pending += 1
+        self._respond(buf, self.state(), req.request_id)
+        asyncio.get_event_loop().call_later(self.tx_delay, self._transmitted, req)
+
+    def _transmitted(self, req):
+        self._requests_pending -= 1
+        self._confirms.append((req.request_id, req.dest, req.src_endpoint))
+        self._notify_state()
+
+    def _data_confirm(self, buf, req):
+        if not self._confirms:
+            self._respond(buf, self.state(), 0, Address(AddressType.NWK, 0, 0), 0, 0, status=Status.FAILURE)
+            return
+        request_id, dest, src_endpoint = self._confirms.popleft()
+        self._respond(buf, self.state(), request_id, dest, src_endpoint, 0)
+
+    def _data_indication(self, buf, req):
+        if not self._indications:
+            self._respond(buf, self.state(), Address(AddressType.NWK, 0, 0), Address(AddressType.NWK, 0, 0),
+                          0, 0, b'', 0, 0, status=Status.FAILURE)
+            return
+        ind = self._indications.popleft()
+        self.stats['indications_delivered'] += 1
+        self._respond(buf, self.state(), Address(AddressType.NWK, self.parameters[NetworkParameter.NWK_ADDR], 1),
+                      ind.src, 0x0104, ind.cluster_id, ind.data, ind.lqi, ind.rssi)
+
+    # virtual devices
+
+    def receive(self, ind):
+        # type: (Indication) -> bool
+        """
+        Puts a frame from the air into the indication buffer, returns False if it had to be dropped
+        """
+        self.stats['indications_generated'] += 1
+        if len(self._indications) >= self.indication_slots:
+            self.stats['indications_dropped'] += 1
+            return False
+        self._indications.append(ind)
+        self._notify_state()
+        return True
+
+    def add_devices(self, count, rate, burst=1):
+        # type: (int, float, int) -> None
+        """
+        Adds `count` end devices, each reporting `rate` times a second on average. Reports arrive in
+        bursts of `burst` frames from consecutive devices, like after a group command or a power glitch.
+        """
+        base = self._device_count
+        self._device_count += count
+        interval = burst / (count * rate)
+        tsn = itertools.count()
+        devices = itertools.cycle(range(base, base + count))
+        loop = asyncio.get_event_loop()
+        slot = len(self._traffic)
+        self._traffic.append(None)
+
+        def tick():
+            for _ in range(burst):
+                n = next(devices)
+                data = _report.pack(0x18, next(tsn) & 0xff, 0x0a, 0x0000, 0x29, 2000 + n)
+                src = Address(AddressType.NWK, DEVICE_NWK_BASE + n, 1)
+                self.receive(Indication(src, TEMPERATURE_CLUSTER, data, 0xff - n % 64, -40 - n % 50))
+            self._traffic[slot] = loop.call_later(interval, tick)
+
+        self._traffic[slot] = loop.call_later(interval, tick)
+
+    def stop_traffic(self):
+        for i in self._traffic:
+            if i is not None:
+                i.cancel()
+        self._traffic = []
+
+
+async def connect(protocol_factory, simulator=None):
+    # type: (typing.Callable[[], asyncio.Protocol], typing.Optional[FirmwareSimulator]) -> typing.Tuple[FirmwareSimulator, asyncio.Protocol]
+    """
+    Connects a protocol, e.g. a `SerialConnection`, to a simulator through a socketpair
+    """
+    loop = asyncio.get_event_loop()
+    simulator = simulator or FirmwareSimulator()
+    dev_sock, host_sock = socket.socketpair()
+    await loop.create_connection(lambda: simulator, sock=dev_sock)
+    _, proto = await loop.create_connection(protocol_factory, sock=host_sock)
+    return simulator, proto
@@ -0,0 +1,112 @@
+import asyncio
+import collections
+import enum
+import typing
+
+
+class OverflowPolicy(enum.Enum):
+    # stop reading indications from the device until the consumer catches up, the firmware buffers them
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+
+
+def _as_set(v):
+    if v is None:
+        return None
+    if isinstance(v, int):
+        return frozenset([v])
+    return frozenset(v)
+
+
+class Subscription:
+    """
+    A bounded queue of incoming messages, created by `SerialConnection.messages`.
+
+    Iterate over it with `async for`; messages not matching the filter are never queued.
+    `dropped` counts the messages lost to the overflow policy. Closing it, or leaving its `with`
+    block, ends the iteration.
+    """
+
+    def __init__(self, conn, maxsize, overflow, cluster_id=None, profile_id=None, src=None, filter=None):
+        # type: (pyconz.connection.SerialConnection, int, OverflowPolicy, ..., typing.Optional[typing.Callable]) -> None
+        self._conn = conn
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self._cluster_ids = _as_set(cluster_id)
+        self._profile_ids = _as_set(profile_id)
+        self._src_addrs = _as_set(src)
+        self._filter = filter
+        self._queue = collections.deque()
+        self._waiter = None     # type: asyncio.Future
+        self.closed = False
+        self.received = 0
+        self.dropped = 0
+
+    def matches(self, msg):
+        # type: (pyconz.connection.Message) -> bool
+        if self._cluster_ids is not None and msg.cluster_id not in self._cluster_ids:
+            return False
+        if self._profile_ids is not None and msg.profile_id not in self._profile_ids:
+            return False
+        if self._src_addrs is not None and msg.src.addr not in self._src_addrs:
+            return False
+        return self._filter is None or self._filter(msg)
+
+    @property
+    def full(self):
+        return len(self._queue) >= self.maxsize
+
+    def __len__(self):
+        return len(self._queue)
+
+    def offer(self, msg):
+        # type: (pyconz.connection.Message) -> None
+        if not self.matches(msg):
+            return
+        self.received += 1
+        if self.full:
+            if self.overflow == OverflowPolicy.DROP_NEWEST:
+                self.dropped += 1
+                return
+            if self.overflow == OverflowPolicy.DROP_OLDEST:
+                self.dropped += 1
+                self._queue.popleft()
+            # BLOCK: the connection stopped reading when the queue filled up, only the answer to a
+            # read that was already on its way can end up here
+        self._queue.append(msg)
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def get_nowait(self):
+        # type: () -> pyconz.connection.Message
+        was_full = self.full
+        msg = self._queue.popleft()
+        if was_full and not self.full and self.overflow == OverflowPolicy.BLOCK:
+            self._conn._subscription_ready()
+        return msg
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._queue:
+            if self.closed:
+                raise StopAsyncIteration
+            self._waiter = asyncio.Future()
+            await self._waiter
+        return self.get_nowait()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._conn._unsubscribe(self)
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,155 @@
+import asyncio
+import collections
+import logging
+import typing
+import zigpy.device
+from .connection import Address, AddressType
+from .zigpy_utils import zigpy_ieee_to_int
+
+logger = logging.getLogger(__name__)
+
+MGMT_LQI_REQUEST = 0x0031
+
+# NeighborType bits 0-1
+DEVICE_TYPE_COORDINATOR = 0
+DEVICE_TYPE_ROUTER = 1
+DEVICE_TYPE_END_DEVICE = 2
+
+# neighbour tables report these when the IEEE address is not known
+_UNKNOWN_IEEE = (0, 0xffffffffffffffff)
+
+Node = collections.namedtuple('Node', ['ieee', 'nwk', 'device_type'])
+Link = collections.namedtuple('Link', ['src_nwk', 'dest_nwk', 'lqi', 'depth'])
+
+# put in the queue by a scan task when it is finished, after all its results
+_ScanDone = collections.namedtuple('_ScanDone', ['ieee', 'nwk', 'ok'])
+
+
+class TopologyCrawler:
+    """
+    Maps the mesh by walking the Mgmt_Lqi neighbour tables of all routers, `concurrency` of them at a time.
+
+    `crawl` is an async iterator of `Node` and `Link` tuples, produced as soon as a neighbour table page
+    arrives. Routers are scanned once, identified by IEEE address (or NWK if a table doesn't report
+    the IEEE). `scanned` holds the IEEE addresses of finished routers and `frontier` the (IEEE, NWK)
+    pairs of routers found but not scanned yet, including failed scans. Passing both to a new
+    crawler resumes an interrupted crawl: it scans the frontier instead of the start device and
+    doesn't scan the finished routers again.
+    """
+
+    def __init__(self, conn, concurrency=4, retries=3, backoff=1.0, scanned=None, frontier=None):
+        # type: (pyconz.zigpy_integ.ZigpyConnection, int, int, float, typing.Optional[typing.Set[int]], typing.Optional[typing.Set[typing.Tuple[int, int]]]) -> None
+        self.conn = conn
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.scanned = set(scanned or ())   # type: typing.Set[int]
+        self.frontier = set(frontier or ())     # type: typing.Set[typing.Tuple[int, int]]
+        self._seen_ieee = set()     # type: typing.Set[int]
+        self._seen_nwk = set()      # type: typing.Set[int]
+
+    def _is_new(self, ieee, nwk):
+        # type: (int, int) -> bool
+        if ieee not in _UNKNOWN_IEEE:
+            if ieee in self._seen_ieee:
+                return False
+            self._seen_ieee.add(ieee)
+        elif nwk in self._seen_nwk:
+            return False
+        self._seen_nwk.add(nwk)
+        return True
+
+    async def crawl(self, start=None):
+        # type: (typing.Optional[zigpy.device.Device]) -> typing.AsyncIterator[typing.Union[Node, Link]]
+        start = start or self.conn.device
+        queue = asyncio.Queue()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = []
+        # scans whose _ScanDone is still to come, their results may still be in the queue
+        running = 0
+
+        def schedule(ieee, nwk):
+            nonlocal running
+            if ieee in self.scanned:
+                return
+            self.frontier.add((ieee, nwk))
+            running += 1
+            tasks.append(asyncio.ensure_future(self._scan(ieee, nwk, semaphore, queue)))
+
+        start_ieee = zigpy_ieee_to_int(start.ieee)
+        self._is_new(start_ieee, start.nwk)
+        yield Node(start_ieee, start.nwk, DEVICE_TYPE_COORDINATOR)
+        schedule(start_ieee, start.nwk)
+        for ieee, nwk in list(self.frontier):
+            if self._is_new(ieee, nwk):
+                schedule(ieee, nwk)
+
+        try:
+            while running:
+                item = await queue.get()
+                if isinstance(item, _ScanDone):
+                    running -= 1
+                    # only done once all of its results went out, an interrupted crawl rescans it
+                    if item.ok:
+                        self.frontier.discard((item.ieee, item.nwk))
+                        if item.ieee not in _UNKNOWN_IEEE:
+                            self.scanned.add(item.ieee)
+                    logger.info("Scanned 0x%04x, %d scans left, %d routers done", item.nwk, running, len(self.scanned))
+                    continue
+                if isinstance(item, Node):
+                    if not self._is_new(item.ieee, item.nwk):
+                        continue
+                    if item.device_type in (DEVICE_TYPE_COORDINATOR, DEVICE_TYPE_ROUTER):
+                        schedule(item.ieee, item.nwk)
+                yield item
+        finally:
+            for i in tasks:
+                i.cancel()
+
+    async def _scan(self, ieee, nwk, semaphore, queue):
+        # type: (int, int, asyncio.Semaphore, asyncio.Queue) -> None
+        ok = False
+        try:
+            async with semaphore:
+                if ieee in _UNKNOWN_IEEE:
+                    dev = self.conn.find_device(Address(AddressType.NWK, nwk, 0))
+                    if dev is None:
+                        logger.warning("Router 0x%04x without known IEEE address, not scanning it", nwk)
+                        return
+                else:
+                    # also takes the NWK address the neighbour table reported, requests go there
+                    dev = await self.conn.get_or_create_device(nwk=nwk, ieee=ieee)
+                await self._scan_device(dev, nwk, queue)
+                ok = True
+        except Exception:
+            logger.exception("Scanning 0x%04x failed", nwk)
+        finally:
+            queue.put_nowait(_ScanDone(ieee, nwk, ok))
+
+    async def _scan_device(self, dev, nwk, queue):
+        # type: (zigpy.device.Device, int, asyncio.Queue) -> None
+        index = 0
+        while True:
+            data = await self._request_lqi(dev, index)
+            entries = list(data.NeighborTableList)
+            for i in entries:
+                n_nwk = i.NWKAddr
+                queue.put_nowait(Node(zigpy_ieee_to_int(i.IEEEAddr), n_nwk, i.NeighborType & 0x03))
+                queue.put_nowait(Link(nwk, n_nwk, i.LQI, i.Depth))
+            index += len(entries)
+            if not entries or data.StartIndex + len(entries) >= data.Entries:
+                return
+
+    async def _request_lqi(self, dev, index):
+        attempt = 0
+        while True:
+            try:
+                status, data = await dev.zdo.request(MGMT_LQI_REQUEST, index)
+                return data
+            except TimeoutError:
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                attempt += 1
+                logger.warning("Mgmt_Lqi request to 0x%04x timed out, retry %d in %.1f s", dev.nwk, attempt, delay)
+                await asyncio.sleep(delay)
@@ -1,21 +1,47 @@
 import struct
+import typing
 from . import protocol
 
+_structs = {}   # type: typing.Dict[str, struct.Struct]
+
+
+def get_struct(fmt):
+    # type: (str) -> struct.Struct
+    try:
+        return _structs[fmt]
+    except KeyError:
+        ret = _structs[fmt] = struct.Struct(fmt)
+        return ret
+
 
 class Buffer:
     def __init__(self, data):
-        self.data = data
-        self.cmd, self.seq, self.status, self.frame_len= self.pop('<BBBH')
+        self._view = memoryview(data)
+        self._pos = 0
+        self.cmd, self.seq, self.status, self.frame_len = self.pop('<BBBH')
         try:
             self.cmd = protocol.CommandId(self.cmd)
         except ValueError:
             pass
         self.status = protocol.Status(self.status)
 
+    @property
+    def data(self):
+        # type: () -> memoryview
+        return self._view[self._pos:]
+
+    def __len__(self):
+        return len(self._view) - self._pos
+
     def pop(self, fmt):
         # type: (str) -> tuple
-        l = struct.calcsize(fmt)
-        return struct.unpack(fmt, self.pop_raw(l))
+        return self.pop_struct(get_struct(fmt))
+
+    def pop_struct(self, s):
+        # type: (struct.Struct) -> tuple
+        ret = s.unpack_from(self._view, self._pos)
+        self._pos += s.size
+        return ret
 
     def pop_int(self, fmt):
         # type: (str) -> int
@@ -26,6 +52,14 @@ class Buffer:
         return cls(self.pop(fmt)[0])
 
     def pop_raw(self, l):
-        buf = self.data[:l]
-        self.data = self.data[l:]
-        return buf
\ No newline at end of file
+        # type: (int) -> memoryview
+        end = self._pos + l
+        if end > len(self._view):
+            raise struct.error("pop_raw requires %d bytes, %d left" % (l, len(self)))
+        ret = self._view[self._pos:end]
+        self._pos = end
+        return ret
+
+    def skip(self, l):
+        # type: (int) -> None
+        self.pop_raw(l)
@@ -1,27 +1,318 @@
 from .connection import SerialConnection, Message, Address, AddressType
 from . import protocol
+from . import capture
+from .correlation import CorrelationTable
 import asyncio
+import collections
+import concurrent.futures
+import copy
+import functools
 import zigpy.zcl
 import logging
 import zigpy.zcl.clusters
 import zigpy.appdb
 import zigpy.application
 import zigpy.device
-from .zigpy_utils import addr_to_zigpy_ieee
+from .zigpy_utils import addr_to_zigpy_ieee, zigpy_ieee_to_int, tsn_offset
+import typing
 
 logger = logging.getLogger(__name__)
 
+# how many devices are interviewed at the same time, each one keeps the mesh busy with ZDO/ZCL requests
+INIT_CONCURRENCY = 4
+# an interview taking longer than this counts as failed, so it doesn't hold its slot forever
+INIT_TIMEOUT = 120.0
+
+# with a deserialization executor, payloads shorter than this are still decoded in the event loop,
+# handing them over costs more than parsing them
+DESERIALIZE_THRESHOLD = 64
+
+# replies of coalesced requests kept for `reply_cache_ttl`, at most this many
+REPLY_CACHE_SIZE = 1024
+
+# requests that change nothing on the device, so identical ones in flight at the same time can share a reply
+_ZDO_READS = frozenset([
+    0x0000, 0x0001, 0x0002, 0x0003, 0x0004, 0x0005,     # NWK_addr ... Active_EP
+    0x0031, 0x0032, 0x0033,     # Mgmt_Lqi, Mgmt_Rtg, Mgmt_Bind
+])
+_ZCL_GLOBAL_READS = frozenset([
+    0x00,   # Read Attributes
+    0x08,   # Read Reporting Configuration
+    0x0c,   # Discover Attributes
+    0x11, 0x13, 0x15,   # Discover Commands Received/Generated, Discover Attributes Extended
+])
+ZCL_FRAME_TYPE_MASK = 0x03
+ZCL_DIRECTION_SERVER_TO_CLIENT = 0x08
+
+GROUPS_CLUSTER = 0x0004
+# ZCL status codes of the Add Group response
+ZCL_SUCCESS = 0x00
+ZCL_DUPLICATE_EXISTS = 0x8a
+
+
+def _reply_key(device, endpoint, cluster, tsn):
+    # type: (int, int, int, int) -> tuple
+    # ZDO responses use the request cluster id with the high bit set
+    if endpoint == 0:
+        cluster &= 0x7fff
+    return device, endpoint, cluster, tsn
+
+
+def _coalescing_key(nwk, profile, cluster, dst_ep, data):
+    # type: (int, int, int, int, bytes) -> typing.Optional[tuple]
+    """
+    Identifies a read-only request by everything but its TSN, None for anything else
+    """
+    offset = tsn_offset(dst_ep, data)
+    if offset is None:
+        return None
+    if dst_ep == 0:
+        if cluster not in _ZDO_READS:
+            return None
+    elif (data[0] & (ZCL_FRAME_TYPE_MASK | ZCL_DIRECTION_SERVER_TO_CLIENT) or len(data) <= offset + 1 or
+          data[offset + 1] not in _ZCL_GLOBAL_READS):
+        return None
+    return nwk, dst_ep, profile, cluster, bytes(data[:offset]) + bytes(data[offset + 1:])
+
+
+def _delivery_error(sent):
+    # type: (pyconz.connection.PendingSend) -> Exception
+    return RuntimeError("Request %d to %s failed with APS status 0x%02x" % (
+        sent.msg.request_id, sent.msg.dest, sent.confirm_status))
+
+
+# the input of a deserialization, picklable for process pools
+DecodeJob = collections.namedtuple('DecodeJob', ['ieee', 'endpoint', 'cluster_id', 'data'])
+
+# zigpy's view of a message, kept in the flight recorder
+Decoded = collections.namedtuple('Decoded', ['src', 'tsn', 'cluster_id', 'is_reply', 'args'])
+
 
 class ZigpyConnection(SerialConnection):
-    def __init__(self):
+    def __init__(self, init_concurrency=INIT_CONCURRENCY, coalesce_requests=False, reply_cache_ttl=0.0,
+                 deserialize_executor=None, deserialize_threshold=DESERIALIZE_THRESHOLD, decode_cache_size=0):
         SerialConnection.__init__(self)
         self.app = zigpy.application.ControllerApplication('/Users/equi/PycharmProjects/raspbee/rbee/db.sqlite')
         self.app.request = self.zigpy_request_proxy
         self.app_ready = False
+        self._app_ready_event = asyncio.Event()
+
+        # With an executor, payloads of deserialize_threshold bytes or more are decoded off the event loop by
+        # decode_job. The default one uses the zigpy devices and works with thread pools; a process pool needs
+        # a picklable module level function taking a DecodeJob instead.
+        self.deserialize_executor = deserialize_executor    # type: typing.Optional[concurrent.futures.Executor]
+        self.deserialize_threshold = deserialize_threshold
+        self.decode_job = self._decode_job  # type: typing.Callable[[DecodeJob], tuple]
+        # per device, messages whose decoding is not finished or that wait for earlier ones
+        # (message, device, future of the decode result, decode cache key)
+        self._decode_queues = {}    # type: typing.Dict[int, typing.Deque[tuple]]
+
+        # Periodic reports repeat the same payload with a new TSN, so decode results are kept in an LRU of
+        # decode_cache_size entries keyed by (IEEE, generation, endpoint, cluster, payload without the TSN).
+        # The TSN is still taken from each frame. A device's generation changes with its endpoints and
+        # clusters, its older entries are never hit again and age out. Every hit gets its own copy of the
+        # args list, the values in it are shared and must not be modified.
+        self.decode_cache_size = decode_cache_size
+        self._decode_cache = collections.OrderedDict()  # type: typing.Dict[tuple, tuple]
+        self._decode_generations = collections.Counter()    # type: typing.Dict[int, int]
+        self.decode_cache_hits = 0
+        self.decode_cache_misses = 0
+
+        self._init_semaphore = asyncio.Semaphore(init_concurrency)
+        self.init_timeout = INIT_TIMEOUT
+        self._init_futures = {}     # type: typing.Dict[int, asyncio.Future]
+
+        # devices by integer IEEE and NWK address, kept up to date through zigpy listener events
+        self._devices_by_ieee = {}  # type: typing.Dict[int, zigpy.device.Device]
+        self._devices_by_nwk = {}   # type: typing.Dict[int, zigpy.device.Device]
+        self._device_nwks = {}      # type: typing.Dict[int, int]
+        # replies are matched by (integer IEEE address, or NWK address of unknown devices, endpoint, cluster, TSN)
+        self._replies = CorrelationTable()
+        # frames zigpy decoded as replies without a request waiting for them, reports included
+        self.unmatched_replies = 0
+
+        # With coalesce_requests, identical read-only requests in flight at the same time go out once and
+        # share the reply, which is reused for reply_cache_ttl seconds.
+        self.coalesce_requests = coalesce_requests
+        self.reply_cache_ttl = reply_cache_ttl
+        self._shared_requests = {}  # type: typing.Dict[tuple, asyncio.Future]
+        self._reply_cache = collections.OrderedDict()   # type: typing.Dict[tuple, typing.Tuple[float, typing.Any]]
+        self.coalesced_requests = 0
+        self.reply_cache_hits = 0
+        # group id -> (integer IEEE address, endpoint) of the members
+        self.groups = {}    # type: typing.Dict[int, typing.Set[typing.Tuple[int, int]]]
+        for dev in self.app.devices.values():
+            self._index_device(dev)
+        self.app.add_listener(self)
+
+    def _index_device(self, dev, index_nwk=True):
+        # type: (zigpy.device.Device, bool) -> None
+        ieee = zigpy_ieee_to_int(dev.ieee)
+        self._devices_by_ieee[ieee] = dev
+        if not index_nwk:
+            return
+        old_nwk = self._device_nwks.get(ieee)
+        if old_nwk is not None and old_nwk != dev.nwk and self._devices_by_nwk.get(old_nwk) is dev:
+            del self._devices_by_nwk[old_nwk]
+        self._device_nwks[ieee] = dev.nwk
+        self._devices_by_nwk[dev.nwk] = dev
+
+    def _unindex_device(self, dev):
+        # type: (zigpy.device.Device) -> None
+        ieee = zigpy_ieee_to_int(dev.ieee)
+        if self._devices_by_ieee.get(ieee) is dev:
+            del self._devices_by_ieee[ieee]
+        nwk = self._device_nwks.pop(ieee, None)
+        if nwk is not None and self._devices_by_nwk.get(nwk) is dev:
+            del self._devices_by_nwk[nwk]
+
+    def _update_nwk(self, dev, nwk):
+        # type: (zigpy.device.Device, typing.Optional[int]) -> None
+        # devices get a new NWK address when they rejoin, placeholders created for IEEE-addressed
+        # frames have none yet
+        if nwk is None or dev.nwk == nwk:
+            return
+        logger.info("Device %s moved from NWK 0x%04x to 0x%04x", dev.ieee, dev.nwk, nwk)
+        dev.nwk = nwk
+        self._index_device(dev)
+
+    def find_device(self, addr):
+        # type: (Address) -> typing.Optional[zigpy.device.Device]
+        if addr.mode == AddressType.IEEE:
+            return self._devices_by_ieee.get(addr.addr)
+        if addr.mode == AddressType.NWK:
+            return self._devices_by_nwk.get(addr.addr)
+        return None
+
+    # groups
+
+    def add_group_member(self, group_id, dev, endpoint=1):
+        # type: (int, zigpy.device.Device, int) -> None
+        """
+        Records a group membership the device already has, `join_group` also configures the device
+        """
+        self.groups.setdefault(group_id, set()).add((zigpy_ieee_to_int(dev.ieee), endpoint))
+
+    def remove_group_member(self, group_id, dev, endpoint=1):
+        # type: (int, zigpy.device.Device, int) -> None
+        members = self.groups.get(group_id)
+        if members is not None:
+            members.discard((zigpy_ieee_to_int(dev.ieee), endpoint))
+            if not members:
+                del self.groups[group_id]
+
+    async def join_group(self, group_id, dev, endpoint=1):
+        # type: (int, zigpy.device.Device, int) -> None
+        """
+        Adds an endpoint of the device to the group with the ZCL Groups cluster
+        """
+        status = (await dev.endpoints[endpoint].in_clusters[GROUPS_CLUSTER].add(group_id, ''))[0]
+        if status not in (ZCL_SUCCESS, ZCL_DUPLICATE_EXISTS):
+            raise RuntimeError("Adding %s to group 0x%04x failed with status 0x%02x" % (dev.ieee, group_id, status))
+        self.add_group_member(group_id, dev, endpoint)
+
+    def _plan_destinations(self, devices, endpoint, broadcast=False):
+        # type: (typing.Iterable[zigpy.device.Device], int, bool) -> typing.List[Address]
+        remaining = {(zigpy_ieee_to_int(d.ieee), endpoint): d for d in devices}
+        if broadcast:
+            coordinator = zigpy_ieee_to_int(self.app.ieee) if self.app.ieee is not None else None
+            others = [i for i in self._devices_by_ieee if i != coordinator]
+            if len(others) > 1 and all((i, endpoint) in remaining for i in others):
+                return [Address(AddressType.NWK, protocol.BROADCAST_ALL, endpoint)]
+
+        ret = []
+        while len(remaining) > 1:
+            # the biggest group with nobody outside the targets, single members are better off with a unicast
+            best = max(((g, m) for g, m in self.groups.items() if len(m) > 1 and m <= remaining.keys()),
+                       key=lambda i: len(i[1]), default=None)
+            if best is None:
+                break
+            group_id, members = best
+            ret.append(Address(AddressType.Group, group_id, protocol.GROUP_ENDPOINT))
+            for i in members:
+                del remaining[i]
+        ret.extend(Address(AddressType.NWK, d.nwk, endpoint) for d in remaining.values())
+        return ret
+
+    def send_to_devices(self, devices, endpoint, profile, cluster, data, src_endpoint=1, broadcast=False):
+        # type: (typing.Iterable[zigpy.device.Device], int, int, int, bytes, int, bool) -> typing.List[asyncio.Future]
+        """
+        Sends the same frame to `endpoint` of all the devices in as few transmissions as possible:
+        one group frame for every known group whose members are all among them (biggest first),
+        unicasts for the rest. Returns the `send_msg` futures.
+
+        With `broadcast`, a single broadcast goes out instead if the devices are all the ones this
+        connection knows of. Devices it doesn't know of, sleeping end devices included, then get
+        the frame too.
+        """
+        ret = []
+        for dest in self._plan_destinations(devices, endpoint, broadcast):
+            msg = Message()
+            msg.dest = dest
+            msg.src = Address(AddressType.IEEE, None, src_endpoint)
+            msg.profile_id = profile
+            msg.cluster_id = cluster
+            msg.data = data
+            msg.request_id = self.app.get_sequence()
+            ret.append(self.send_msg(msg))
+        return ret
+
+    # zigpy application listener
+
+    def device_joined(self, device):
+        self._index_device(device)
+        self._forget_decoded(device)
+
+    def device_initialized(self, device):
+        self._index_device(device)
+        self._forget_decoded(device)
+        fut = self._init_futures.pop(zigpy_ieee_to_int(device.ieee), None)
+        if fut is not None and not fut.done():
+            fut.set_result(device)
+
+    def device_left(self, device):
+        self._unindex_device(device)
+        self._forget_decoded(device)
+
+    def device_removed(self, device):
+        self._unindex_device(device)
+        self._forget_decoded(device)
 
     async def zigpy_request_proxy(self, nwk, profile, cluster, src_ep, dst_ep, sequence, data, expect_reply=True, timeout=10):
-        logger.warning('Request proxy: %s', [nwk, profile, cluster, src_ep, dst_ep, sequence, data, expect_reply, timeout])
-        ret = asyncio.Future()
+        logger.debug('Request proxy: %s', [nwk, profile, cluster, src_ep, dst_ep, sequence, data, expect_reply, timeout])
+        key = None
+        if self.coalesce_requests and expect_reply:
+            key = _coalescing_key(nwk, profile, cluster, dst_ep, data)
+        if key is None:
+            return await self._zigpy_request(nwk, profile, cluster, src_ep, dst_ep, sequence, data, expect_reply, timeout)
+
+        cached = self._reply_cache.get(key)
+        if cached is not None:
+            if cached[0] > asyncio.get_event_loop().time():
+                self.reply_cache_hits += 1
+                return cached[1]
+            del self._reply_cache[key]
+        shared = self._shared_requests.get(key)
+        if shared is None:
+            shared = asyncio.ensure_future(
+                self._zigpy_request(nwk, profile, cluster, src_ep, dst_ep, sequence, data, expect_reply, timeout))
+            self._shared_requests[key] = shared
+            shared.add_done_callback(functools.partial(self._shared_request_done, key))
+        else:
+            self.coalesced_requests += 1
+        # one caller giving up doesn't cancel the request for the others
+        return await asyncio.shield(shared)
+
+    def _shared_request_done(self, key, fut):
+        del self._shared_requests[key]
+        if self.reply_cache_ttl <= 0 or fut.cancelled() or fut.exception() is not None:
+            return
+        self._reply_cache[key] = (asyncio.get_event_loop().time() + self.reply_cache_ttl, fut.result())
+        self._reply_cache.move_to_end(key)
+        if len(self._reply_cache) > REPLY_CACHE_SIZE:
+            self._reply_cache.popitem(last=False)
+
+    async def _zigpy_request(self, nwk, profile, cluster, src_ep, dst_ep, sequence, data, expect_reply, timeout):
         if src_ep:
             src_ep = 1
         msg = Message()
@@ -32,71 +323,217 @@ class ZigpyConnection(SerialConnection):
         msg.data = data
         msg.request_id = sequence
 
-        self.send_msg(msg)
+        if not expect_reply:
+            sent = await self.send_msg(msg)
+            if sent.confirm_status:
+                raise _delivery_error(sent)
+            return None
 
-        self.zigpy_futures[sequence] = ret
-        done, pending = await asyncio.wait([ret], timeout=timeout)
-        if ret in pending:
-            logger.error("Request %d timed out!", sequence)
-            raise TimeoutError()
+        dev = self._devices_by_nwk.get(nwk)
+        key = _reply_key(zigpy_ieee_to_int(dev.ieee) if dev is not None else nwk, dst_ep, cluster, sequence)
+        reply = self._replies.add(key, timeout)
+        sent = self.send_msg(msg)
+        sent.add_done_callback(functools.partial(self._request_sent, key, reply))
+        try:
+            return await reply
+        except TimeoutError:
+            logger.error("Request %d to 0x%04x timed out!", sequence, nwk)
+            raise
 
-        return ret.result()
+    def _request_sent(self, key, reply, sent):
+        # a frame that never made it out won't get a reply either
+        if sent.cancelled() or reply.done():
+            return
+        exc = sent.exception()
+        if exc is None:
+            if not sent.result().confirm_status:
+                return
+            exc = _delivery_error(sent.result())
+        self._replies.pop(key)
+        reply.set_exception(exc)
 
     async def get_or_create_device(self, nwk, ieee) -> zigpy.device.Device:
         assert ieee
+        if not isinstance(ieee, zigpy.types.EUI64):
+            ieee = addr_to_zigpy_ieee(ieee)
+        dev = self._devices_by_ieee.get(zigpy_ieee_to_int(ieee))
+        if dev is not None:
+            self._update_nwk(dev, nwk)
+            pending = self._init_futures.get(zigpy_ieee_to_int(ieee))
+            if pending is not None:
+                # somebody else is creating it, wait for the same initialization
+                await asyncio.wait([pending])
+            return dev
         try:
-            return self.app.get_device(ieee=ieee, nwk=nwk)
+            dev = self.app.get_device(ieee=ieee, nwk=nwk)
+            self._index_device(dev)
+            self._update_nwk(dev, nwk)
         except KeyError:
-            if not isinstance(ieee, zigpy.types.EUI64):
-                ieee = addr_to_zigpy_ieee(ieee)
             dev = self.app.add_device(ieee, nwk)
+            self._index_device(dev)
             self.logger.warning("New device created, scheduling initalization and waiting")
-            dev.schedule_initialize()
+            try:
+                await self.initialize_device(dev)
+            except Exception as e:
+                logger.error("Initialization of %s failed: %s", dev.ieee, e)
+        return dev
 
-            # FIXME ugly!
-            while dev.initializing:
-                logger.warning("Waiting for initialization, status: %s", dev.status)
-                await asyncio.sleep(1)
-        return self.app.get_device(nwk=nwk)
+    def initialize_device(self, dev):
+        # type: (zigpy.device.Device) -> asyncio.Future
+        """
+        Interviews the device, at most `init_concurrency` at a time. The future gets the device once
+        zigpy reports it initialized; concurrent calls for the same device share it.
+        """
+        ieee = zigpy_ieee_to_int(dev.ieee)
+        fut = self._init_futures.get(ieee)
+        if fut is None:
+            fut = self._init_futures[ieee] = asyncio.Future()
+            asyncio.ensure_future(self._run_initialization(dev, fut))
+        return fut
 
+    async def _run_initialization(self, dev, fut):
+        async with self._init_semaphore:
+            if fut.done():
+                return
+            dev.schedule_initialize()
+            # A failed initialization produces no listener event, so we also watch zigpy's init task
+            # and treat it ending without the event as a failure. Without the task, only the timeout
+            # tells.
+            task = getattr(dev, '_init_handle', None)
+            waiting = [fut] if task is None else [fut, task]
+            done, _ = await asyncio.wait(waiting, timeout=self.init_timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not fut.done():
+                if self._init_futures.get(zigpy_ieee_to_int(dev.ieee)) is fut:
+                    del self._init_futures[zigpy_ieee_to_int(dev.ieee)]
+                if not done:
+                    fut.set_exception(TimeoutError("Initialization of %s timed out" % (dev.ieee, )))
+                else:
+                    fut.set_exception(RuntimeError("Initialization of %s failed, status %s" % (dev.ieee, dev.status)))
 
     async def wait_for_startup(self):
-        while not self.app_ready:
-            await asyncio.sleep(0.1)
+        await self._app_ready_event.wait()
 
     async def startup(self):
-        my_nwk = await self.get_parameter(protocol.NetworkParameter.NWK_ADDR)
-        my_ieee = await self.get_parameter(protocol.NetworkParameter.MAC_ADDR)
+        my_nwk, my_ieee = await asyncio.gather(
+            self.get_parameter(protocol.NetworkParameter.NWK_ADDR),
+            self.get_parameter(protocol.NetworkParameter.MAC_ADDR),
+        )
         self.app._ieee = addr_to_zigpy_ieee(my_ieee)
         self.app._nwk = my_nwk
         logging.warning("my NWK: 0x%x, my_ieee: %s", my_nwk, self.app.ieee)
         self.device = await self.get_or_create_device(self.app.nwk, self.app.ieee)
         self.app_ready = True
+        self._app_ready_event.set()
         logging.warning("Startup completed")
 
 
     def handle_incoming_message(self, msg: Message):
-        self.logger.warning('Data: %s', msg)
-        if msg.src.mode == AddressType.IEEE:
-            ieee = addr_to_zigpy_ieee(msg.src)
-            try:
-                dev = self.app.get_device(ieee=ieee)    # type: zigpy.device.Device
-            except KeyError:
-                self.app.add_device(ieee=ieee, nwk=0)
-                dev = self.app.get_device(ieee=ieee)    # type: zigpy.device.Device
-
-            if msg.src.endpoint:
-                dev.add_endpoint(msg.src.endpoint)
-                tsn, cluster_id, is_reply, args = dev.deserialize(msg.src.endpoint, msg.cluster_id, msg.data)
-            else:
-                tsn, cluster_id, is_reply, args = dev.zdo.deserialize(msg.cluster_id, msg.data)
-            logger.warning('tsn: %s, cluster_id: 0x%04x, is_reply: %s, args: %s', tsn, cluster_id, is_reply, args)
-            if is_reply:
-                try:
-                    fut = self.zigpy_futures[tsn]   # type: asyncio.Future
-                except KeyError:
-                    logger.error("No future to match tsn %d", tsn)
-                else:
-                    fut.set_result(args)
+        self.logger.debug('Data: %s', msg)
+        dev = self.find_device(msg.src)     # type: zigpy.device.Device
+        if dev is None:
+            if msg.src.mode != AddressType.IEEE:
+                logger.error("Message from unknown device %s", msg.src)
+                return
+            # the NWK address is not known yet, don't let the placeholder shadow the coordinator
+            dev = self.app.add_device(ieee=addr_to_zigpy_ieee(msg.src), nwk=0)
+            self._index_device(dev, index_nwk=False)
+
+        if msg.src.endpoint and msg.src.endpoint not in dev.endpoints:
+            dev.add_endpoint(msg.src.endpoint)
+            self._forget_decoded(dev)
+        job = DecodeJob(zigpy_ieee_to_int(dev.ieee), msg.src.endpoint, msg.cluster_id, msg.data)
+        key = decoded = None
+        if self.decode_cache_size:
+            key, decoded = self._cached_decode(job)
+        offload = (decoded is None and self.deserialize_executor is not None and
+                   len(msg.data) >= self.deserialize_threshold)
+        queue = self._decode_queues.get(job.ieee)
+        if queue is None and not offload:
+            if decoded is None:
+                decoded = self._decode_job(job)
+                self._cache_decoded(key, decoded)
+            self._handle_decoded(msg, dev, decoded)
+            return
+
+        # results are handled in arrival order per device, so a frame waits for earlier offloaded ones
+        if offload:
+            fut = asyncio.get_event_loop().run_in_executor(self.deserialize_executor, self.decode_job, job)
         else:
-            logging.error("TODO: handle messages with source NWK address")
+            fut = asyncio.Future()
+            try:
+                fut.set_result(decoded if decoded is not None else self._decode_job(job))
+            except Exception as e:
+                fut.set_exception(e)
+        if queue is None:
+            queue = self._decode_queues[job.ieee] = collections.deque()
+        queue.append((msg, dev, fut, key))
+        fut.add_done_callback(functools.partial(self._flush_decoded, job.ieee))
+
+    def _cached_decode(self, job):
+        # type: (DecodeJob) -> typing.Tuple[typing.Optional[tuple], typing.Optional[tuple]]
+        """
+        Returns the cache key of the job and the cached decode result with this frame's TSN, if there is one
+        """
+        offset = tsn_offset(job.endpoint, job.data)
+        if offset is None:
+            return None, None
+        data = job.data
+        payload = data[:offset] + data[offset + 1:]
+        key = (job.ieee, self._decode_generations[job.ieee], job.endpoint, job.cluster_id, payload)
+        cached = self._decode_cache.get(key)
+        if cached is None:
+            self.decode_cache_misses += 1
+            return key, None
+        self.decode_cache_hits += 1
+        self._decode_cache.move_to_end(key)
+        tsn, cluster_id, is_reply, args = cached
+        return key, (data[offset], cluster_id, is_reply, copy.copy(args))
+
+    def _cache_decoded(self, key, decoded):
+        # type: (typing.Optional[tuple], tuple) -> None
+        if key is None:
+            return
+        # not the list handed to the message handlers, they may change it
+        self._decode_cache[key] = decoded[:3] + (copy.copy(decoded[3]), )
+        self._decode_cache.move_to_end(key)
+        if len(self._decode_cache) > self.decode_cache_size:
+            self._decode_cache.popitem(last=False)
+
+    def _forget_decoded(self, dev):
+        # type: (zigpy.device.Device) -> None
+        """
+        Invalidates the cached decode results of a device, also those of decodes still running
+        """
+        self._decode_generations[zigpy_ieee_to_int(dev.ieee)] += 1
+
+    def _decode_job(self, job):
+        # type: (DecodeJob) -> tuple
+        dev = self._devices_by_ieee[job.ieee]
+        if job.endpoint:
+            return dev.deserialize(job.endpoint, job.cluster_id, job.data)
+        return dev.zdo.deserialize(job.cluster_id, job.data)
+
+    def _flush_decoded(self, ieee, _=None):
+        queue = self._decode_queues.get(ieee)
+        while queue and queue[0][2].done():
+            msg, dev, fut, key = queue.popleft()
+            try:
+                self._cache_decoded(key, fut.result())
+                self._handle_decoded(msg, dev, fut.result())
+            except Exception:
+                self.logger.exception("Error while processing message %s", msg)
+        if queue is not None and not queue:
+            del self._decode_queues[ieee]
+
+    def _handle_decoded(self, msg, dev, decoded):
+        # type: (Message, zigpy.device.Device, tuple) -> None
+        tsn, cluster_id, is_reply, args = decoded
+        logger.debug('tsn: %s, cluster_id: 0x%04x, is_reply: %s, args: %s', tsn, cluster_id, is_reply, args)
+        self.recorder.record(capture.DECODED, Decoded(msg.src, tsn, cluster_id, is_reply, args))
+        if is_reply:
+            endpoint = msg.src.endpoint
+            if not (self._replies.resolve(_reply_key(zigpy_ieee_to_int(dev.ieee), endpoint, msg.cluster_id, tsn), args) or
+                    self._replies.resolve(_reply_key(dev.nwk, endpoint, msg.cluster_id, tsn), args)):
+                # attribute reports have the server to client direction of replies too, so this is common
+                self.unmatched_replies += 1
+                logger.debug("No request to match the reply from %s, cluster 0x%04x, tsn %d", msg.src, msg.cluster_id, tsn)
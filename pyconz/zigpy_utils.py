@@ -1,4 +1,5 @@
 from .connection import Address, AddressType
+import typing
 import zigpy.types
 
 def addr_to_zigpy_ieee(addr: Address):
@@ -15,4 +16,28 @@ def addr_to_zigpy_ieee(addr: Address):
     while len(l) < 8:
         l.append(zigpy.types.uint8_t(addr_v % 256))
         addr_v //= 256
-    return zigpy.types.EUI64(l)
\ No newline at end of file
+    return zigpy.types.EUI64(l)
+
+
+def zigpy_ieee_to_int(ieee):
+    # type: (zigpy.types.EUI64) -> int
+    # EUI64 keeps the bytes in wire (little endian) order
+    return int.from_bytes(bytes(ieee), 'little')
+
+
+# ZCL frame control bit telling that a manufacturer code precedes the TSN
+ZCL_MANUFACTURER_SPECIFIC = 0x04
+
+
+def tsn_offset(endpoint, data):
+    # type: (int, bytes) -> typing.Optional[int]
+    """
+    Position of the TSN in a ZDO (endpoint 0) or ZCL frame, None if the frame is too short
+    """
+    if endpoint == 0:
+        offset = 0
+    elif not data:
+        return None
+    else:
+        offset = 3 if data[0] & ZCL_MANUFACTURER_SPECIFIC else 1
+    return offset if offset < len(data) else None
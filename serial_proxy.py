@@ -4,61 +4,122 @@ import serial
 import typing
 import logging
 import binascii
+import argparse
 
 loop = asyncio.get_event_loop()
+logger = logging.getLogger(__name__)
+
+# a client with more than this many bytes waiting in its socket buffer is disconnected
+DEFAULT_CLIENT_BUFFER = 256 * 1024
 
 
 class SocketForwardingProtocol(asyncio.Protocol):
-    def __init__(self, tty):
+    def __init__(self, tty, read_only=False, max_buffer=DEFAULT_CLIENT_BUFFER):
         self.peer = tty         # type: ProxyConnection
         self.transport = None   # type: asyncio.Transport
+        self.read_only = read_only
+        self.max_buffer = max_buffer
 
     def data_received(self, data):
+        if self.read_only:
+            return
         if not self.peer:
-            logging.error("Peer is None, wtf?")
+            logger.error("Peer is None, wtf?")
             return
         if self.peer.transport is None:
-            logging.error("Peer not ready")
+            logger.error("Peer not ready")
             return
-        logging.warning('cli->dev: %s', binascii.hexlify(data).decode())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('cli->dev: %s', binascii.hexlify(data).decode())
         self.peer.transport.write(data)
 
+    def send(self, data):
+        # type: (bytes) -> bool
+        """
+        Forwards device data, returns False if the client fell too far behind and was dropped
+        """
+        self.transport.write(data)
+        if self.transport.get_write_buffer_size() > self.max_buffer:
+            logger.warning("Client %s is %d bytes behind, dropping it",
+                           self.transport.get_extra_info('peername'), self.transport.get_write_buffer_size())
+            self.transport.abort()
+            return False
+        return True
+
     def connection_made(self, transport):
         self.transport = transport
+        if self.read_only and self.peer:
+            # only now there is a transport to forward to
+            self.peer.subscribers.add(self)
+
+    def connection_lost(self, exc):
+        if self.peer:
+            self.peer.client_lost(self)
 
 
 class ProxyConnection(asyncio.Protocol):
 
-    def __init__(self):
+    def __init__(self, port='/dev/ttyS0', baudrate=38400, max_buffer=DEFAULT_CLIENT_BUFFER):
         self.socket = None      # type: SocketForwardingProtocol
-        self.transport = serial.aio.SerialTransport(loop, self, serial.Serial('/dev/ttyS0', baudrate=38400))
+        self.subscribers = set()    # type: typing.Set[SocketForwardingProtocol]
+        self.max_buffer = max_buffer
+        self.transport = serial.aio.SerialTransport(loop, self, serial.Serial(port, baudrate=baudrate))
 
     def data_received(self, data):
         super().data_received(data)
-        logging.warning("dev->cli: %s", binascii.hexlify(data).decode())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("dev->cli: %s", binascii.hexlify(data).decode())
         if self.socket and self.socket.transport:
-            self.socket.transport.write(data)
-        else:
-            logging.warning("No active socket connection")
+            if not self.socket.send(data):
+                self.socket = None
+        for i in list(self.subscribers):
+            if not i.send(data):
+                self.subscribers.discard(i)
 
     def socket_factory(self):
-        logging.warning("Got new connection")
+        logger.warning("Got new connection")
         if self.socket:
-            logging.warning("Closing existing client socket")
+            logger.warning("Closing existing client socket")
             self.socket.transport.close()
             self.socket.peer = None
-        self.socket = SocketForwardingProtocol(self)
+        self.socket = SocketForwardingProtocol(self, max_buffer=self.max_buffer)
         return self.socket
 
+    def subscriber_factory(self):
+        logger.warning("Got new read-only connection, %d subscribers", len(self.subscribers) + 1)
+        return SocketForwardingProtocol(self, read_only=True, max_buffer=self.max_buffer)
+
+    def client_lost(self, client):
+        # type: (SocketForwardingProtocol) -> None
+        self.subscribers.discard(client)
+        if self.socket is client:
+            self.socket = None
+
 
 def main():
-    logging.basicConfig(format='[%(asctime)s - %(message)s')
-    pc = ProxyConnection()
-    server = loop.create_server(pc.socket_factory, host='0.0.0.0', port=9999, reuse_address=True)
+    parser = argparse.ArgumentParser(description="Forwards a serial port over TCP")
+    parser.add_argument('--port', default='/dev/ttyS0', help="serial port")
+    parser.add_argument('--baudrate', type=int, default=38400)
+    parser.add_argument('--host', default='0.0.0.0', help="address to listen on")
+    parser.add_argument('--listen-port', type=int, default=9999,
+                        help="TCP port for the client controlling the device, a new connection replaces the old one")
+    parser.add_argument('--reader-port', type=int, default=None,
+                        help="TCP port for any number of read-only clients receiving the device output")
+    parser.add_argument('--client-buffer', type=int, default=DEFAULT_CLIENT_BUFFER,
+                        help="clients with more unsent bytes than this are disconnected")
+    parser.add_argument('--verbose', action='store_true', help="log all forwarded data")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='[%(asctime)s - %(message)s', level=logging.DEBUG if args.verbose else logging.WARNING)
+    pc = ProxyConnection(args.port, args.baudrate, args.client_buffer)
+    server = loop.create_server(pc.socket_factory, host=args.host, port=args.listen_port, reuse_address=True)
     asyncio.ensure_future(server)
+    if args.reader_port is not None:
+        readers = loop.create_server(pc.subscriber_factory, host=args.host, port=args.reader_port, reuse_address=True)
+        asyncio.ensure_future(readers)
 
     loop.run_forever()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,85 @@
+import asyncio
+from pyconz import capture
+
+
+class Recorder(asyncio.Protocol):
+    def __init__(self):
+        self.chunks = []
+        self.lost = False
+
+    def data_received(self, data):
+        self.chunks.append(data)
+
+    def connection_lost(self, exc):
+        self.lost = True
+
+
+def test_roundtrip(tmp_path):
+    path = str(tmp_path / 'cap.bin')
+    w = capture.CaptureWriter(path)
+    w.record(capture.DEVICE_TO_HOST, b'\xc0abc\xc0')
+    w.record(capture.HOST_TO_DEVICE, b'\xc0x\xc0')
+    w.record(capture.DEVICE_TO_HOST, bytes(70000))
+    w.close()
+
+    r = capture.CaptureReader(path)
+    records = [(i.direction, bytes(i.data)) for i in r]
+    r.close()
+    assert records == [
+        (capture.DEVICE_TO_HOST, b'\xc0abc\xc0'),
+        (capture.HOST_TO_DEVICE, b'\xc0x\xc0'),
+        (capture.DEVICE_TO_HOST, bytes(0xffff)),
+        (capture.DEVICE_TO_HOST, bytes(70000 - 0xffff)),
+    ]
+
+
+def test_replay(tmp_path):
+    path = str(tmp_path / 'cap.bin')
+    w = capture.CaptureWriter(path)
+    for i in range(10):
+        w.record(capture.DEVICE_TO_HOST, bytes([i]))
+        w.record(capture.HOST_TO_DEVICE, b'ignored')
+    w.close()
+
+    async def replay():
+        proto = Recorder()
+        transport = capture.ReplayTransport(path, proto)
+        assert await transport.done == 10
+        return proto
+
+    proto = asyncio.run(replay())
+    assert proto.chunks == [bytes([i]) for i in range(10)]
+    assert proto.lost
+
+
+def test_close_during_realtime_replay(tmp_path):
+    path = str(tmp_path / 'cap.bin')
+    w = capture.CaptureWriter(path)
+    w.record(capture.DEVICE_TO_HOST, b'now')
+    # a minute later
+    w._start -= 60
+    w.record(capture.DEVICE_TO_HOST, b'later')
+    w.close()
+
+    async def replay():
+        proto = Recorder()
+        transport = capture.ReplayTransport(path, proto, realtime=True)
+        await asyncio.sleep(0.05)
+        transport.close()
+        return proto, await transport.done
+
+    proto, replayed = asyncio.run(replay())
+    assert proto.chunks == [b'now']
+    assert proto.lost
+    assert replayed == 1
+
+
+def test_flight_recorder():
+    r = capture.FlightRecorder(size=2)
+    r.record(capture.DEVICE_TO_HOST, b'\x17\x01')
+    r.record(capture.DECODED, 'report')
+    r.record(capture.HOST_TO_DEVICE, memoryview(b'\x04\x02'))
+    lines = r.format()
+    assert len(lines) == 2
+    assert lines[0].endswith('   report')
+    assert lines[1].endswith('-> 0402')
@@ -0,0 +1,292 @@
+import asyncio
+import pytest
+from pyconz import simulator
+from pyconz import connection
+from pyconz.connection import SerialConnection, Message, SendPriority
+from pyconz.protocol import *
+
+
+class Connection(SerialConnection):
+    def handle_incoming_message(self, msg):
+        pass
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def connect(**kwargs):
+    sim, conn = await simulator.connect(Connection, simulator.FirmwareSimulator(**kwargs))
+    # let the hello exchange finish
+    await asyncio.sleep(0.05)
+    return sim, conn
+
+
+def test_request_timeout():
+    async def main():
+        sim, conn = await connect()
+        sim.responding = False
+        with pytest.raises(TimeoutError):
+            await conn._request(CommandId.DEVICE_STATE, timeout=0.02)
+        # a zero timeout is not the default one
+        with pytest.raises(TimeoutError):
+            await asyncio.wait_for(conn._request(CommandId.DEVICE_STATE, timeout=0), 1)
+        return conn
+
+    conn = run(main())
+    assert not conn._requests
+    assert len(conn._free_seqs) == 256
+    assert conn.metrics.request_timeouts == 2
+
+
+def test_sequence_numbers_reused_late():
+    async def main():
+        sim, conn = await connect()
+        first = conn._free_seqs[0]
+        await conn.request_dev_state()
+        return conn, first
+
+    conn, first = run(main())
+    assert conn._free_seqs[-1] == first
+    assert len(set(conn._free_seqs)) == 256
+
+
+def test_hold_back_when_sequence_numbers_run_out():
+    async def main():
+        sim, conn = await connect()
+        sim.responding = False
+        futs = [conn._request(CommandId.DEVICE_STATE, timeout=0.05) for _ in range(300)]
+        assert len(conn._requests) == 256
+        assert len(conn._seq_waiters) == 44
+        await asyncio.sleep(0.02)
+        # the held back requests go out as the first ones time out, and get answered
+        sim.responding = True
+        return conn, await asyncio.gather(*futs, return_exceptions=True)
+
+    conn, results = run(main())
+    assert all(isinstance(i, TimeoutError) for i in results[:256])
+    assert all(isinstance(i, int) for i in results[256:])
+    assert conn.metrics.seq_exhausted == 44
+    assert not conn._requests and not conn._seq_waiters
+
+
+def test_parameter_cache():
+    async def main():
+        sim, conn = await connect()
+        reads = [conn.get_parameter(NetworkParameter.NWK_PANID) for _ in range(3)]
+        assert reads[0] is reads[1] is reads[2]
+        values = await asyncio.gather(*reads)
+        cached = await conn.get_parameter(NetworkParameter.NWK_PANID)
+        return conn, values, cached
+
+    conn, values, cached = run(main())
+    assert values == [0x1a62] * 3
+    assert cached == 0x1a62
+    assert conn.metrics.frames_out[CommandId.READ_PARAMETER.value] == 1
+
+
+def test_write_during_read():
+    async def main():
+        sim, conn = await connect()
+        read = conn.get_parameter(NetworkParameter.NWK_PANID)
+        await conn.set_parameter(NetworkParameter.NWK_PANID, 0x4321)
+        # the read went out before the write, its value must not end up in the cache
+        assert await read == 0x1a62
+        return await conn.get_parameter(NetworkParameter.NWK_PANID)
+
+    assert run(main()) == 0x4321
+
+
+def test_conf_changed_invalidates():
+    async def main():
+        sim, conn = await connect()
+        await conn.get_parameter(NetworkParameter.NWK_PANID)
+        sim.parameters[NetworkParameter.NWK_PANID] = 0x1111
+        conn._handle_dev_state_value(NetworkState.CONNECTED.value | DeviceState.CONF_CHANGED.value)
+        return await conn.get_parameter(NetworkParameter.NWK_PANID)
+
+    assert run(main()) == 0x1111
+
+
+def test_drain_ends_without_data():
+    async def main():
+        sim, conn = await connect()
+        # nothing buffered, the device answers the read with a failure
+        conn._read_indications()
+        await asyncio.sleep(0.05)
+        return conn
+
+    conn = run(main())
+    assert conn._drain_started is None and conn._indication_read is None
+    assert conn.metrics.drain_time.count == 1
+
+
+def test_drain_reset_on_timeout():
+    async def main():
+        sim, conn = await connect()
+        sim.responding = False
+        conn.request_timeout = 0.02
+        conn._read_indications()
+        await asyncio.sleep(0.05)
+        return conn
+
+    conn = run(main())
+    assert conn._drain_started is None and conn._indication_read is None
+    assert conn.metrics.drain_time.count == 0
+
+
+class BatchConnection(Connection):
+    def __init__(self):
+        super().__init__()
+        self.batch_delivery = True
+        self.batches = []
+
+    def handle_incoming_messages(self, msgs):
+        self.batches.append([i.data[1] for i in msgs])
+
+
+def test_batch_delivery():
+    async def main():
+        sim, conn = await simulator.connect(BatchConnection, simulator.FirmwareSimulator(indication_slots=16))
+        await asyncio.sleep(0.05)
+        conn.max_batch = 4
+        for i in range(10):
+            sim.receive(simulator.Indication(Address(AddressType.NWK, 0x1234, 1), 0x0402, bytes([0x18, i, 0x0a]), 200, -40))
+        await asyncio.sleep(0.1)
+        return conn
+
+    conn = run(main())
+    # one drain, cut at max_batch
+    assert conn.batches == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+
+def aps_message(request_id):
+    msg = Message()
+    msg.dest = Address(AddressType.NWK, 0x1234, 1)
+    msg.src = Address(AddressType.IEEE, None, 1)
+    msg.profile_id = 0x0104
+    msg.cluster_id = 0x0006
+    msg.data = bytes([0x01, request_id, 0x01])
+    msg.request_id = request_id
+    return msg
+
+
+def record_requests(sim, busy=0):
+    """
+    Records the request ids of the APS requests the simulator gets, answers the first `busy` with BUSY
+    """
+    ids = []
+    handler = sim._handlers[CommandId.APS_DATA_REQUEST]
+
+    def record(buf, req):
+        nonlocal busy
+        ids.append(req.request_id)
+        if busy:
+            busy -= 1
+            sim._respond(buf, sim.state(), req.request_id, status=Status.BUSY)
+        else:
+            handler(buf, req)
+    sim._handlers[CommandId.APS_DATA_REQUEST] = record
+    return ids
+
+
+def test_send_waits_for_credit():
+    async def main():
+        sim, conn = await connect(request_slots=0)
+        ids = record_requests(sim)
+        fut = conn.send_msg(aps_message(1))
+        await asyncio.sleep(0.15)
+        # only polled the device state
+        assert not ids and not fut.done() and len(conn._aps_queue) == 1
+        sim.request_slots = 1
+        send = await fut
+        return ids, send
+
+    ids, send = run(main())
+    assert ids == [1]
+    assert send.confirm_status == 0
+
+
+def test_send_busy_keeps_place():
+    async def main():
+        sim, conn = await connect(request_slots=0)
+        ids = record_requests(sim, busy=1)
+        futs = [conn.send_msg(aps_message(i)) for i in range(1, 4)]
+        sim.request_slots = 1
+        await asyncio.gather(*futs)
+        return ids
+
+    # the rejected first request goes out again before the others
+    assert run(main()) == [1, 1, 2, 3]
+
+
+def test_send_priority():
+    async def main():
+        sim, conn = await connect(request_slots=0)
+        ids = record_requests(sim)
+        futs = [conn.send_msg(aps_message(i), SendPriority.BACKGROUND) for i in range(1, 3)]
+        futs.append(conn.send_msg(aps_message(3)))
+        sim.request_slots = 1
+        await asyncio.gather(*futs)
+        return ids
+
+    assert run(main()) == [3, 1, 2]
+
+
+def test_send_ack_timeout(monkeypatch):
+    monkeypatch.setattr(connection, 'APS_REQUEST_ACK_TIMEOUT', 0.05)
+
+    async def main():
+        sim, conn = await connect()
+        sim.responding = False
+        with pytest.raises(TimeoutError):
+            await conn.send_msg(aps_message(1))
+        return conn
+
+    conn = run(main())
+    assert not conn._aps_in_flight and not conn._aps_unconfirmed
+
+
+def test_send_confirmed():
+    async def main():
+        sim, conn = await connect()
+        futs = [conn.send_msg(aps_message(i)) for i in range(1, 4)]
+        return await asyncio.gather(*futs)
+
+    sends = run(main())
+    # each confirm completes the send with its request id
+    assert [i.msg.request_id for i in sends] == [1, 2, 3]
+    for i in sends:
+        assert i.confirm_status == 0
+        assert i.enqueued_at <= i.sent_at <= i.acked_at <= i.confirmed_at
+        assert i.latency >= i.radio_delay >= 0
+
+
+def test_send_request_id_reused():
+    async def main():
+        sim, conn = await connect(tx_delay=0.1)
+        first = conn.send_msg(aps_message(1))
+        await asyncio.sleep(0.05)
+        # accepted by the device, not confirmed yet
+        second = conn.send_msg(aps_message(1))
+        with pytest.raises(RuntimeError):
+            await first
+        return conn, await second
+
+    conn, send = run(main())
+    assert send.confirm_status == 0
+    assert conn.metrics.request_id_evictions == 1
+
+
+def test_send_confirm_timeout(monkeypatch):
+    monkeypatch.setattr(connection, 'APS_CONFIRM_TIMEOUT', 0.1)
+
+    async def main():
+        # acknowledged, but the radio never gets to send it
+        sim, conn = await connect(tx_delay=10)
+        with pytest.raises(TimeoutError):
+            await conn.send_msg(aps_message(1))
+        return conn
+
+    conn = run(main())
+    assert not conn._aps_unconfirmed
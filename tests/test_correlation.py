@@ -0,0 +1,49 @@
+import asyncio
+import pytest
+from pyconz.correlation import CorrelationTable
+
+
+def test_resolve_and_expire():
+    async def run():
+        table = CorrelationTable()
+        a = table.add((1, 1, 6, 5), 0.01)
+        b = table.add((2, 1, 6, 5), 0.01)
+        assert table.resolve((1, 1, 6, 5), 'reply')
+        assert not table.resolve((1, 1, 6, 5), 'late reply')
+        with pytest.raises(TimeoutError):
+            await b
+        return table, await a
+
+    table, result = asyncio.run(run())
+    assert result == 'reply'
+    assert len(table) == 0
+
+
+def test_bounded():
+    async def run():
+        table = CorrelationTable()
+        for i in range(10000):
+            table.add(i, 60)
+            table.resolve(i, None)
+        return table
+
+    table = asyncio.run(run())
+    assert len(table) == 0
+    assert len(table._deadlines) < 100
+
+
+def test_on_expire():
+    expired = []
+
+    async def run():
+        table = CorrelationTable(lambda key, fut: expired.append((key, fut)))
+        fut = asyncio.Future()
+        assert table.add(1, 0.01, fut) is fut
+        await asyncio.sleep(0.05)
+        return table, fut
+
+    table, fut = asyncio.run(run())
+    assert expired == [(1, fut)]
+    # left to the callback
+    assert not fut.done()
+    assert len(table) == 0
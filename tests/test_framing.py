@@ -0,0 +1,41 @@
+import binascii
+from pyconz import framing
+from pyconz.protocol import crc
+
+# device status
+test_msg07 = binascii.unhexlify(b'0701000800aa000244ff')
+
+# incoming data
+test_msg17 = binascii.unhexlify(b'1702002b0024002a0200000103336a0e00002618840304010600070018880a0000100000af1faa000104ab04fb')
+
+
+def test_check_crc():
+    assert framing.check_crc(test_msg07)
+    assert framing.check_crc(test_msg17)
+    assert not framing.check_crc(test_msg07[:-1] + b'\x00')
+
+
+def test_decode_split():
+    stream = framing.encode(test_msg07) + framing.encode(test_msg17)
+    dec = framing.FrameDecoder()
+    frames = []
+    for i in range(len(stream)):
+        frames += [bytes(f) for f in dec.feed(stream[i:i + 1])]
+    assert frames == [test_msg07[:-2], test_msg17[:-2]]
+
+
+def test_escaping():
+    body = b'\x07\x01\x00\x0a\x00\xc0\xdb\xdc\xdd'
+    frame = body + crc(body)
+    packet = framing.encode(frame)
+    assert packet.count(b'\xc0') == 2
+    assert [bytes(f) for f in framing.FrameDecoder().feed(packet)] == [body]
+
+
+def test_invalid_frame():
+    bad = []
+    dec = framing.FrameDecoder(bad.append)
+    frames = list(dec.feed(b'STARTING APP\r\n' + framing.encode(test_msg07)))
+    assert [bytes(f) for f in frames] == [test_msg07[:-2]]
+    assert dec.crc_errors == 1
+    assert b'STARTING APP' in bad[0]
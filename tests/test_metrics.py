@@ -0,0 +1,27 @@
+from pyconz.metrics import ConnectionMetrics, Histogram
+from pyconz.protocol import CommandId
+
+
+def test_histogram():
+    h = Histogram([0.1, 1.0])
+    for i in 0.05, 0.1, 0.5, 3.0:
+        h.observe(i)
+    assert h.counts == [2, 1, 1]
+    assert h.snapshot()['count'] == 4
+
+
+def test_prometheus():
+    m = ConnectionMetrics()
+    m.frames_in[CommandId.APS_DATA_INDICATION.value] += 3
+    m.frames_in[0x99] += 1
+    m.request_latency[CommandId.READ_PARAMETER].observe(0.003)
+    m.gauges['pending_requests'] = lambda: 2
+    text = m.prometheus()
+    assert 'pyconz_frames_received_total{command="APS_DATA_INDICATION"} 3\n' in text
+    assert 'pyconz_frames_received_total{command="0x99"} 1\n' in text
+    assert 'pyconz_request_latency_seconds_bucket{command="READ_PARAMETER",le="0.0025"} 0\n' in text
+    assert 'pyconz_request_latency_seconds_bucket{command="READ_PARAMETER",le="0.005"} 1\n' in text
+    assert 'pyconz_request_latency_seconds_count{command="READ_PARAMETER"} 1\n' in text
+    assert 'pyconz_drain_time_seconds_count 0\n' in text
+    assert 'pyconz_pending_requests 2\n' in text
+    assert m.snapshot()['frames_in'] == {'APS_DATA_INDICATION': 3, '0x99': 1}
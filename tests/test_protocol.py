@@ -0,0 +1,61 @@
+import binascii
+import struct
+from pyconz import protocol
+from pyconz.protocol import CommandId, AddressType, Address, NetworkParameter
+from pyconz.utils import Buffer
+
+# incoming data
+test_msg17 = binascii.unhexlify(b'1702002b0024002a0200000103336a0e00002618840304010600070018880a0000100000af1faa000104ab04fb')
+
+
+def test_encode_fixed():
+    assert protocol.encode(CommandId.READ_PARAMETER, 3, NetworkParameter.NWK_ADDR) == \
+        struct.pack('<BBBHHB', 0x0a, 3, 0, 8, 1, 0x07)
+    assert protocol.encode(CommandId.DEVICE_STATE, 4) == struct.pack('<BBBHBBB', 0x07, 4, 0, 8, 0, 0, 0)
+
+
+def test_encode_variable():
+    assert protocol.encode(CommandId.WRITE_PARAMETER, 3, NetworkParameter.NWK_PANID, 0x1234) == \
+        struct.pack('<BBBHHBH', 0x0b, 3, 0, 10, 3, 0x05, 0x1234)
+
+    data = b'\x01\x02\x03'
+    frame = protocol.encode(CommandId.APS_DATA_REQUEST, 6, 9, 0, Address(AddressType.NWK, 0x1234, 1), 0x0104, 6, 1, data)
+    pl = struct.pack('<BBBHBHHBH', 9, 0, 0x02, 0x1234, 1, 0x0104, 6, 1, len(data)) + data + struct.pack('<BB', 0, 5)
+    assert frame == struct.pack('<BBBHH', 0x12, 6, 0, len(pl) + 7, len(pl)) + pl
+
+    frame = protocol.encode(CommandId.APS_DATA_REQUEST, 6, 9, 0, Address(AddressType.Group, 0x0002, None), 0x0104, 6, 1, data)
+    assert frame[7:12] == struct.pack('<BBBH', 9, 0, 0x01, 0x0002)
+    assert frame[12:16] == struct.pack('<HH', 0x0104, 6)
+
+
+def test_decode_indication():
+    ind = protocol.decode(Buffer(test_msg17[:-2]))
+    assert ind.dev_st == 0x2a
+    assert ind.src == Address(AddressType.IEEE, 0x84182600000e6a33, 3)
+    assert ind.dest == Address(AddressType.NWK, 0, 1)
+    assert ind.profile_id == 0x0104
+    assert ind.cluster_id == 0x6
+    assert ind.data == binascii.unhexlify(b'18880a00001000')
+    assert ind.lqi == 0x1f
+    assert ind.rssi == -85
+
+
+def test_decode_group_indication():
+    # the destination endpoint is there for group addresses too
+    data = b'\x18\x05\x0a\x00\x00\x10\x01'
+    pl = struct.pack('<BBHBBHBHHH', 0x2a, 0x01, 0x0002, 0x01, 0x02, 0x1234, 0x03, 0x0104, 0x0006, len(data)) + data + \
+        struct.pack('<BBBBBBBb', 0, 0, 0xc8, 0, 0, 0, 0, -50)
+    frame = struct.pack('<BBBHH', 0x17, 1, 0, len(pl) + 7, len(pl)) + pl
+    ind = protocol.decode(Buffer(frame))
+    assert ind.dest == Address(AddressType.Group, 0x0002, 1)
+    assert ind.src == Address(AddressType.NWK, 0x1234, 3)
+    assert ind.data == data
+    assert ind.lqi == 0xc8
+    assert ind.rssi == -50
+    assert protocol.response_schemas[CommandId.APS_DATA_INDICATION].encode(1, *ind) == frame
+
+
+def test_address_str():
+    assert str(Address(AddressType.NWK, 0x1234, 1)) == '1234.01 (AddressType.NWK)'
+    assert str(Address(AddressType.Group, 0x0002, None)) == '2.-- (AddressType.Group)'
+    assert str(Address(AddressType.IEEE, None, 1)) == '-.01 (AddressType.IEEE)'
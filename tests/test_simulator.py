@@ -0,0 +1,59 @@
+import asyncio
+from pyconz import framing, protocol, simulator
+from pyconz.protocol import *
+from pyconz.utils import Buffer
+
+
+class FakeTransport:
+    def __init__(self):
+        self.frames = []
+        self._decoder = framing.FrameDecoder(None)
+
+    def write(self, data):
+        self.frames.extend(bytes(i) for i in self._decoder.feed(data))
+
+
+def send(sim, cmd, seq, *args):
+    frame = protocol.encode(cmd, seq, *args)
+    sim.data_received(framing.encode(frame + crc(frame)))
+
+
+def responses(transport, cmd):
+    ret = []
+    for i in transport.frames:
+        buf = Buffer(i)
+        if buf.cmd == cmd:
+            ret.append((buf.seq, buf.status, protocol.decode(buf)))
+    return ret
+
+
+def test_parameters():
+    sim = simulator.FirmwareSimulator()
+    t = FakeTransport()
+    sim.connection_made(t)
+    send(sim, CommandId.WRITE_PARAMETER, 1, NetworkParameter.NWK_PANID, 0x1234)
+    send(sim, CommandId.READ_PARAMETER, 2, NetworkParameter.NWK_PANID)
+    assert responses(t, CommandId.READ_PARAMETER) == [(2, Status.SUCCESS, (NetworkParameter.NWK_PANID, 0x1234))]
+
+
+def test_indication_buffer_overflow():
+    async def run():
+        sim = simulator.FirmwareSimulator(indication_slots=2)
+        t = FakeTransport()
+        sim.connection_made(t)
+        for i in range(3):
+            ind = simulator.Indication(Address(AddressType.NWK, 0x1000 + i, 1), 6, b'\x18\x00\x0b', 0xff, -40)
+            sim.receive(ind)
+        send(sim, CommandId.APS_DATA_INDICATION, 1)
+        send(sim, CommandId.APS_DATA_INDICATION, 2)
+        send(sim, CommandId.APS_DATA_INDICATION, 3)
+        return sim, t
+
+    sim, t = asyncio.run(run())
+    assert sim.stats['indications_dropped'] == 1
+    res = responses(t, CommandId.APS_DATA_INDICATION)
+    assert [i[2].src.addr for i in res[:2]] == [0x1000, 0x1001]
+    assert res[2][1] == Status.FAILURE
+    # the last state change announces the empty buffer
+    state = responses(t, CommandId.DEVICE_STATE_CHANGED)[-1][2].state
+    assert not state & DeviceState.APSDE_DATA_INDICATION.value
@@ -0,0 +1,57 @@
+import asyncio
+import collections
+from pyconz.protocol import Address, AddressType
+from pyconz.subscription import Subscription, OverflowPolicy
+
+Msg = collections.namedtuple('Msg', ['src', 'profile_id', 'cluster_id'])
+
+
+class FakeConnection:
+    def __init__(self):
+        self.ready = 0
+        self.unsubscribed = []
+
+    def _subscription_ready(self):
+        self.ready += 1
+
+    def _unsubscribe(self, sub):
+        self.unsubscribed.append(sub)
+
+
+def msg(n, cluster_id=6):
+    return Msg(Address(AddressType.NWK, n, 1), 0x0104, cluster_id)
+
+
+def test_drop_policies_and_filter():
+    conn = FakeConnection()
+    oldest = Subscription(conn, 2, OverflowPolicy.DROP_OLDEST, cluster_id=6)
+    newest = Subscription(conn, 2, OverflowPolicy.DROP_NEWEST, src=[1, 2, 3])
+    for i in 1, 2, 3, 4:
+        oldest.offer(msg(i))
+        newest.offer(msg(i))
+    oldest.offer(msg(5, cluster_id=8))
+    assert [m.src.addr for m in oldest._queue] == [3, 4]
+    assert oldest.dropped == 2
+    assert [m.src.addr for m in newest._queue] == [1, 2]
+    assert (newest.received, newest.dropped) == (3, 1)
+
+
+def test_block_and_iterate():
+    async def run():
+        conn = FakeConnection()
+        sub = Subscription(conn, 2, OverflowPolicy.BLOCK)
+        for i in 1, 2, 3:
+            sub.offer(msg(i))
+        got = []
+        with sub:
+            async for m in sub:
+                got.append(m.src.addr)
+                if len(got) == 3:
+                    break
+        return conn, sub, got
+
+    conn, sub, got = asyncio.run(run())
+    assert got == [1, 2, 3]
+    assert sub.dropped == 0
+    assert conn.ready == 1
+    assert conn.unsubscribed == [sub]
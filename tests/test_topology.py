@@ -0,0 +1,107 @@
+import asyncio
+import collections
+from pyconz import topology
+
+Neighbor = collections.namedtuple('Neighbor', ['IEEEAddr', 'NWKAddr', 'NeighborType', 'LQI', 'Depth'])
+LqiResponse = collections.namedtuple('LqiResponse', ['NeighborTableList', 'StartIndex', 'Entries'])
+
+# NWK address -> neighbours (NWK address, device type); 3 and 4 are end devices
+MESH = {
+    0: [(1, 1), (2, 1), (3, 2)],
+    1: [(0, 0), (2, 1), (4, 2)],
+    2: [(1, 1), (5, 1)],
+    5: [(2, 1)],
+}
+
+
+def ieee(nwk):
+    return list((0x100 + nwk).to_bytes(8, 'little'))
+
+
+class Zdo:
+    def __init__(self, net, nwk):
+        self.net = net
+        self.nwk = nwk
+
+    async def request(self, cmd, index):
+        await asyncio.sleep(0)
+        self.net.requests[self.nwk] += 1
+        if self.nwk in self.net.broken:
+            raise RuntimeError("Unreachable")
+        entries = [Neighbor(ieee(n), n, t, 200, 1) for n, t in MESH[self.nwk]]
+        return 0, LqiResponse(entries[index:index + 2], index, len(entries))
+
+
+class Device:
+    def __init__(self, net, nwk):
+        self.nwk = nwk
+        self.ieee = ieee(nwk)
+        self.zdo = Zdo(net, nwk)
+
+
+class Network:
+    def __init__(self, broken=()):
+        self.broken = set(broken)
+        self.requests = collections.Counter()
+        self.device = Device(self, 0)
+
+    def find_device(self, addr):
+        return None
+
+    async def get_or_create_device(self, nwk, ieee):
+        return Device(self, nwk)
+
+
+def crawl(crawler):
+    async def run():
+        return [i async for i in crawler.crawl()]
+    return asyncio.run(run())
+
+
+def nodes(items):
+    return {i.nwk for i in items if isinstance(i, topology.Node)}
+
+
+def test_crawl():
+    net = Network()
+    crawler = topology.TopologyCrawler(net)
+    items = crawl(crawler)
+    assert nodes(items) == set(range(6))
+    assert crawler.scanned == {topology.zigpy_ieee_to_int(ieee(i)) for i in MESH}
+    assert not crawler.frontier
+    # every router once, tables of 3 neighbours take 2 pages
+    assert net.requests == {0: 2, 1: 2, 2: 1, 5: 1}
+
+
+def test_resume():
+    net = Network(broken={2})
+    first = topology.TopologyCrawler(net)
+    assert nodes(crawl(first)) == {0, 1, 2, 3, 4}
+    assert first.frontier == {(topology.zigpy_ieee_to_int(ieee(2)), 2)}
+
+    net.broken.clear()
+    net.requests.clear()
+    second = topology.TopologyCrawler(net, scanned=first.scanned, frontier=first.frontier)
+    items = crawl(second)
+    assert 5 in nodes(items)
+    assert net.requests == {2: 1, 5: 1}
+    assert not second.frontier
+
+
+def test_resume_interrupted():
+    net = Network()
+    first = topology.TopologyCrawler(net)
+
+    async def run():
+        items = []
+        async for i in first.crawl():
+            items.append(i)
+            if len(items) == 4:
+                break
+        return items
+
+    items = asyncio.run(run())
+    assert first.frontier
+    second = topology.TopologyCrawler(net, scanned=first.scanned, frontier=first.frontier)
+    assert nodes(items) | nodes(crawl(second)) == set(range(6))
+    assert second.scanned == {topology.zigpy_ieee_to_int(ieee(i)) for i in MESH}
@@ -0,0 +1,34 @@
+import binascii
+import struct
+import pytest
+from pyconz.utils import Buffer
+from pyconz import protocol
+
+test_msg0a_mac = binascii.unhexlify(b'0a05001000090001e77f01ffff2e210023fc')
+
+
+def test_pop_cursor():
+    b = Buffer(test_msg0a_mac)
+    assert len(b) == len(test_msg0a_mac) - 5
+    assert b.pop_int('<H') == 9
+    assert b.pop_enum('B', protocol.NetworkParameter) == protocol.NetworkParameter.MAC_ADDR
+    assert b.pop_int('<Q') == 0x00212effff017fe7
+    assert len(b) == 2
+
+
+def test_pop_raw_is_view():
+    data = bytearray(test_msg0a_mac)
+    b = Buffer(data)
+    raw = b.pop_raw(3)
+    assert isinstance(raw, memoryview)
+    assert raw.tobytes() == data[5:8]
+    assert len(b) == len(data) - 8
+
+
+def test_pop_past_end():
+    b = Buffer(test_msg0a_mac)
+    b.skip(len(b) - 1)
+    with pytest.raises(struct.error):
+        b.pop_int('<H')
+    with pytest.raises(struct.error):
+        b.pop_raw(2)
@@ -0,0 +1,405 @@
+import asyncio
+import concurrent.futures
+import logging
+import time
+import pytest
+import zigpy.application
+from pyconz import simulator
+from pyconz import zigpy_integ
+from pyconz.protocol import *
+from pyconz.zigpy_utils import zigpy_ieee_to_int
+
+
+def ieee(n):
+    return list((0x00124b0000000000 + n).to_bytes(8, 'little'))
+
+
+class Zdo:
+    def deserialize(self, cluster_id, data):
+        return data[0], cluster_id, bool(cluster_id & 0x8000), [bytes(data[1:])]
+
+
+class Device:
+    def __init__(self, app, ieee, nwk):
+        self.app = app
+        self.ieee = ieee
+        self.nwk = nwk
+        self.endpoints = {0: None}
+        self.zdo = Zdo()
+        self.status = 0
+        self.decoded = 0
+
+    def add_endpoint(self, endpoint):
+        self.endpoints[endpoint] = None
+
+    def schedule_initialize(self):
+        for i in self.app.listeners:
+            asyncio.get_event_loop().call_soon(i.device_initialized, self)
+
+    def deserialize(self, endpoint, cluster_id, data):
+        # ZCL: frame control, TSN, command id, payload
+        self.decoded += 1
+        return data[1], data[2], bool(data[0] & 0x08), [list(data[3:])]
+
+
+class Application:
+    def __init__(self, database_file=None):
+        self.devices = {}
+        self.listeners = []
+        self._ieee = None
+        self._nwk = 0
+        self._tsn = 0
+
+    @property
+    def ieee(self):
+        return self._ieee
+
+    @property
+    def nwk(self):
+        return self._nwk
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def get_sequence(self):
+        self._tsn = (self._tsn + 1) & 0xff
+        return self._tsn
+
+    def get_device(self, ieee=None, nwk=None):
+        return self.devices[bytes(ieee)]
+
+    def add_device(self, ieee, nwk):
+        dev = self.devices[bytes(ieee)] = Device(self, ieee, nwk)
+        return dev
+
+
+@pytest.fixture(autouse=True)
+def fake_app(monkeypatch):
+    monkeypatch.setattr(zigpy.application, 'ControllerApplication', Application)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def add_devices(conn, count):
+    ret = []
+    for n in range(1, count + 1):
+        dev = conn.app.add_device(ieee(n), 0x1000 + n)
+        dev.add_endpoint(1)
+        conn._index_device(dev)
+        ret.append(dev)
+    return ret
+
+
+def test_plan_destinations():
+    conn = zigpy_integ.ZigpyConnection()
+    devs = add_devices(conn, 5)
+    for i in devs[:3]:
+        conn.add_group_member(1, i)
+    conn.add_group_member(2, devs[3])
+    conn.add_group_member(2, devs[4])
+
+    # groups whose members are all targets, biggest first, unicasts for the rest
+    assert conn._plan_destinations(devs, 1) == [
+        Address(AddressType.Group, 1, GROUP_ENDPOINT), Address(AddressType.Group, 2, GROUP_ENDPOINT)]
+    assert conn._plan_destinations(devs[:4], 1) == [
+        Address(AddressType.Group, 1, GROUP_ENDPOINT), Address(AddressType.NWK, 0x1004, 1)]
+    # a group with a member outside the targets is not used
+    assert sorted(conn._plan_destinations(devs[1:4], 1)) == [
+        Address(AddressType.NWK, 0x1002 + i, 1) for i in range(3)]
+    # membership is per endpoint
+    assert conn._plan_destinations(devs[:3], 2) == [Address(AddressType.NWK, 0x1001 + i, 2) for i in range(3)]
+
+
+def test_plan_broadcast():
+    conn = zigpy_integ.ZigpyConnection()
+    devs = add_devices(conn, 3)
+    # devices outside this process would run the command too, so only on request
+    assert len(conn._plan_destinations(devs, 1)) == 3
+    assert conn._plan_destinations(devs, 1, broadcast=True) == [Address(AddressType.NWK, BROADCAST_ALL, 1)]
+    assert len(conn._plan_destinations(devs[:2], 1, broadcast=True)) == 2
+
+
+def test_nwk_change():
+    async def main():
+        conn = zigpy_integ.ZigpyConnection()
+        msg = zigpy_integ.Message()
+        msg.src = Address(AddressType.IEEE, zigpy_ieee_to_int(ieee(1)), 1)
+        msg.dest = Address(AddressType.NWK, 0, 1)
+        msg.profile_id = 0x0104
+        msg.cluster_id = 0x0006
+        msg.data = b'\x18\x01\x0a\x00\x00\x10\x01'
+        # a placeholder without NWK address
+        conn.handle_incoming_message(msg)
+        dev = await conn.get_or_create_device(nwk=0x1234, ieee=zigpy_ieee_to_int(ieee(1)))
+        assert dev.nwk == 0x1234
+        assert conn.find_device(Address(AddressType.NWK, 0x1234, 1)) is dev
+        # rejoined with a new address
+        assert await conn.get_or_create_device(nwk=0x4321, ieee=zigpy_ieee_to_int(ieee(1))) is dev
+        assert dev.nwk == 0x4321
+        assert conn.find_device(Address(AddressType.NWK, 0x4321, 1)) is dev
+        assert conn.find_device(Address(AddressType.NWK, 0x1234, 1)) is None
+
+    asyncio.run(main())
+
+
+class Connection(zigpy_integ.ZigpyConnection):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.handled = []
+
+    def _handle_decoded(self, msg, dev, decoded):
+        self.handled.append(decoded)
+        super()._handle_decoded(msg, dev, decoded)
+
+
+def report(nwk, tsn, value, endpoint=1):
+    msg = zigpy_integ.Message()
+    msg.src = Address(AddressType.NWK, nwk, endpoint)
+    msg.dest = Address(AddressType.NWK, 0, 1)
+    msg.profile_id = 0x0104
+    msg.cluster_id = 0x0402
+    # Report Attributes, server to client
+    msg.data = bytes([0x10, tsn, 0x0a, 0x00, 0x00, 0x29]) + value.to_bytes(2, 'little')
+    return msg
+
+
+def test_decode_cache():
+    conn = Connection(decode_cache_size=2)
+    dev, = add_devices(conn, 1)
+    conn.handle_incoming_message(report(dev.nwk, 1, 2000))
+    conn.handle_incoming_message(report(dev.nwk, 2, 2000))
+    assert dev.decoded == 1 and conn.decode_cache_hits == 1
+    # the TSN comes from the frame, the args are not shared
+    first, second = conn.handled
+    assert (first[0], second[0]) == (1, 2)
+    assert first[3] == second[3] and first[3] is not second[3]
+    second[3].clear()
+    conn.handle_incoming_message(report(dev.nwk, 3, 2000))
+    assert conn.handled[-1][3] == first[3]
+
+    # least recently used entries go first
+    conn.handle_incoming_message(report(dev.nwk, 4, 2001))
+    conn.handle_incoming_message(report(dev.nwk, 5, 2002))
+    assert len(conn._decode_cache) == 2
+    conn.handle_incoming_message(report(dev.nwk, 6, 2000))
+    assert dev.decoded == 4
+
+
+def test_decode_cache_invalidation():
+    conn = Connection(decode_cache_size=8)
+    dev, = add_devices(conn, 1)
+    conn.handle_incoming_message(report(dev.nwk, 1, 2000))
+    conn.device_initialized(dev)
+    conn.handle_incoming_message(report(dev.nwk, 2, 2000))
+    assert dev.decoded == 2
+    # a frame from a new endpoint changes the device
+    conn.handle_incoming_message(report(dev.nwk, 3, 2000, endpoint=2))
+    conn.handle_incoming_message(report(dev.nwk, 4, 2000))
+    assert dev.decoded == 4
+    conn.handle_incoming_message(report(dev.nwk, 5, 2000))
+    assert dev.decoded == 4
+
+
+def long_report(nwk, tsn, value):
+    msg = report(nwk, tsn, value)
+    # more reported attributes
+    msg.data += bytes(24)
+    return msg
+
+
+def offloading_connection():
+    conn = Connection(deserialize_executor=concurrent.futures.ThreadPoolExecutor(1), deserialize_threshold=16)
+    decode_job = conn.decode_job
+
+    def slow_decode_job(job):
+        time.sleep(0.05)
+        if job.data[1] == 0xee:
+            raise ValueError("Broken frame")
+        return decode_job(job)
+    conn.decode_job = slow_decode_job
+    return conn
+
+
+def test_deserialize_threshold():
+    async def main():
+        conn = offloading_connection()
+        dev, = add_devices(conn, 1)
+        conn.handle_incoming_message(report(dev.nwk, 1, 2000))
+        # short frames are decoded right away
+        assert [i[0] for i in conn.handled] == [1]
+        conn.handle_incoming_message(long_report(dev.nwk, 2, 2000))
+        assert len(conn.handled) == 1
+        await asyncio.sleep(0.2)
+        return conn
+
+    conn = run(main())
+    assert [i[0] for i in conn.handled] == [1, 2]
+
+
+def test_deserialize_order():
+    async def main():
+        conn = offloading_connection()
+        a, b = add_devices(conn, 2)
+        conn.handle_incoming_message(long_report(a.nwk, 1, 2000))
+        conn.handle_incoming_message(report(a.nwk, 2, 2000))
+        conn.handle_incoming_message(report(b.nwk, 3, 2000))
+        await asyncio.sleep(0.2)
+        return conn
+
+    conn = run(main())
+    # the short frame waits for the earlier one of its device, other devices don't
+    assert [i[0] for i in conn.handled] == [3, 1, 2]
+    assert not conn._decode_queues
+
+
+def test_deserialize_error():
+    async def main():
+        conn = offloading_connection()
+        dev, = add_devices(conn, 1)
+        conn.handle_incoming_message(long_report(dev.nwk, 0xee, 2000))
+        conn.handle_incoming_message(report(dev.nwk, 2, 2000))
+        await asyncio.sleep(0.2)
+        return conn
+
+    conn = run(main())
+    assert [i[0] for i in conn.handled] == [2]
+    assert not conn._decode_queues
+
+
+
+def zcl_frame(command, tsn, payload=b'', frame_control=0x00):
+    return bytes([frame_control, tsn, command]) + payload
+
+
+def test_coalescing_key():
+    read = zcl_frame(0x00, 1, b'\x00\x00')
+    key = zigpy_integ._coalescing_key(0x1234, 0x0104, 0x0006, 1, read)
+    # the TSN is not part of it
+    assert key is not None and key == zigpy_integ._coalescing_key(0x1234, 0x0104, 0x0006, 1, zcl_frame(0x00, 2, b'\x00\x00'))
+    assert key != zigpy_integ._coalescing_key(0x1234, 0x0104, 0x0006, 2, read)
+    # Write Attributes, a cluster command, a reply
+    assert zigpy_integ._coalescing_key(0x1234, 0x0104, 0x0006, 1, zcl_frame(0x02, 1, b'\x00\x00\x10\x01')) is None
+    assert zigpy_integ._coalescing_key(0x1234, 0x0104, 0x0006, 1, zcl_frame(0x01, 1, frame_control=0x01)) is None
+    assert zigpy_integ._coalescing_key(0x1234, 0x0104, 0x0006, 1, zcl_frame(0x00, 1, b'\x00\x00', 0x08)) is None
+    # ZDO: Mgmt_Lqi yes, Mgmt_Leave no
+    assert zigpy_integ._coalescing_key(0x1234, 0, 0x0031, 0, b'\x01\x00') is not None
+    assert zigpy_integ._coalescing_key(0x1234, 0, 0x0034, 0, b'\x01' + bytes(9)) is None
+
+
+async def coalescing_connection(reply_cache_ttl=0.0):
+    sim, conn = await simulator.connect(
+        lambda: Connection(coalesce_requests=True, reply_cache_ttl=reply_cache_ttl), simulator.FirmwareSimulator())
+    await conn.wait_for_startup()
+    dev, = add_devices(conn, 1)
+    return sim, conn, dev
+
+
+def request(conn, dev, tsn, command=0x00, payload=b'\x00\x00'):
+    return asyncio.ensure_future(conn.zigpy_request_proxy(
+        dev.nwk, 0x0104, 0x0006, 1, 1, tsn, zcl_frame(command, tsn, payload), timeout=1))
+
+
+def reply(sim, dev, tsn):
+    # Read Attributes Response: on/off is on
+    sim.receive(simulator.Indication(
+        Address(AddressType.NWK, dev.nwk, 1), 0x0006, zcl_frame(0x01, tsn, b'\x00\x00\x00\x10\x01', 0x18), 200, -40))
+
+
+def aps_requests(conn):
+    return conn.metrics.frames_out[CommandId.APS_DATA_REQUEST.value]
+
+
+def test_coalesce_reads():
+    async def main():
+        sim, conn, dev = await coalescing_connection()
+        first = request(conn, dev, 1)
+        second = request(conn, dev, 2)
+        await asyncio.sleep(0.05)
+        assert aps_requests(conn) == 1
+        reply(sim, dev, 1)
+        return conn, await first, await second
+
+    conn, first, second = run(main())
+    assert first == second == [[0x00, 0x00, 0x00, 0x10, 0x01]]
+    assert conn.coalesced_requests == 1
+
+
+def test_coalesce_writes():
+    async def main():
+        sim, conn, dev = await coalescing_connection()
+        for tsn in (1, 2):
+            request(conn, dev, tsn, 0x02, b'\x00\x00\x10\x01')
+        await asyncio.sleep(0.05)
+        return conn
+
+    conn = run(main())
+    assert aps_requests(conn) == 2
+    assert conn.coalesced_requests == 0
+
+
+def test_reply_cache_ttl():
+    async def main():
+        sim, conn, dev = await coalescing_connection(reply_cache_ttl=0.1)
+        first = request(conn, dev, 1)
+        await asyncio.sleep(0.05)
+        reply(sim, dev, 1)
+        await first
+        assert await request(conn, dev, 2) == await first
+        assert aps_requests(conn) == 1
+        await asyncio.sleep(0.15)
+        request(conn, dev, 3)
+        await asyncio.sleep(0.05)
+        return conn
+
+    conn = run(main())
+    assert aps_requests(conn) == 2
+    assert conn.reply_cache_hits == 1
+
+
+def test_coalesced_cancel():
+    async def main():
+        sim, conn, dev = await coalescing_connection()
+        first = request(conn, dev, 1)
+        second = request(conn, dev, 2)
+        await asyncio.sleep(0.05)
+        first.cancel()
+        await asyncio.sleep(0)
+        reply(sim, dev, 1)
+        return first, await second
+
+    first, second = run(main())
+    assert first.cancelled()
+    assert second == [[0x00, 0x00, 0x00, 0x10, 0x01]]
+
+
+def test_unmatched_reply(caplog):
+    conn = Connection()
+    dev, = add_devices(conn, 1)
+    msg = report(dev.nwk, 1, 2000)
+    # a report with the server to client direction bit, decoded as a reply
+    msg.data = bytes([0x18]) + msg.data[1:]
+    with caplog.at_level(logging.INFO):
+        conn.handle_incoming_message(msg)
+    assert conn.unmatched_replies == 1
+    assert not caplog.records
+
+
+def test_initialization_timeout():
+    async def main():
+        conn = Connection(init_concurrency=1)
+        conn.init_timeout = 0.05
+        silent, working = add_devices(conn, 2)
+        # the interview fails without telling
+        silent.schedule_initialize = lambda: None
+        failed = conn.initialize_device(silent)
+        # waits for the free slot
+        done = conn.initialize_device(working)
+        await asyncio.wait([done], timeout=1)
+        return conn, failed, done
+
+    conn, failed, done = run(main())
+    assert isinstance(failed.exception(), TimeoutError)
+    assert done.result().nwk == 0x1002
+    assert not conn._init_futures